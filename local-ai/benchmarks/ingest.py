@@ -0,0 +1,248 @@
+"""Ingest benchmark over a synthetic repository.
+
+Run from the local-ai directory, e.g.
+
+    python -m benchmarks.ingest --python-files 1000 --ts-files 1000 --output bench.json
+
+Prints (or writes) one JSON document with wall time, files/sec, rows/sec and
+the peak RSS so far after each stage, so runs on different commits can be diffed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+
+from benchmarks.synthetic_repo import RepoSpec, generate_repo
+
+
+def parse_args():
+    defaults = RepoSpec()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--python-files", type=int, default=defaults.python_files)
+    parser.add_argument("--ts-files", type=int, default=defaults.ts_files)
+    parser.add_argument(
+        "--declarations", type=int, default=defaults.declarations_per_file
+    )
+    parser.add_argument(
+        "--statements", type=int, default=defaults.statements_per_declaration
+    )
+    parser.add_argument("--fan-out", type=int, default=defaults.import_fan_out)
+    parser.add_argument("--depth", type=int, default=defaults.nesting_depth)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--touch", type=int, default=10, help="Files changed before re-ingesting"
+    )
+    parser.add_argument("--output", help="Write results here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    return parser.parse_args()
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux, and the peak over the whole run so far
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def run_stage(name, fn, files):
+    """Time `fn`, which returns the number of rows it produced or wrote."""
+    start = time.perf_counter()
+    rows = fn()
+    wall = time.perf_counter() - start
+    (rss, children_rss) = peak_rss_kb()
+    return {
+        "stage": name,
+        "wall_s": round(wall, 4),
+        "files": files,
+        "files_per_s": round(files / wall, 1) if wall else None,
+        "rows": rows,
+        "rows_per_s": round(rows / wall, 1) if wall else None,
+        "cumulative_peak_rss_kb": rss,
+        "children_cumulative_peak_rss_kb": children_rss,
+    }
+
+
+def command_output(command, cwd=None):
+    try:
+        result = subprocess.run(command, cwd=cwd, capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def typescript_available(parser_path):
+    return (
+        command_output(
+            ["node", "-e", "require('typescript')"], cwd=os.path.dirname(parser_path)
+        )
+        is not None
+    )
+
+
+def main():
+    args = parse_args()
+    spec = RepoSpec(
+        python_files=args.python_files,
+        ts_files=args.ts_files,
+        declarations_per_file=args.declarations,
+        statements_per_declaration=args.statements,
+        import_fan_out=args.fan_out,
+        nesting_depth=args.depth,
+        seed=args.seed,
+    )
+    workdir = tempfile.mkdtemp(prefix="ingest-benchmark-")
+    repo = os.path.join(workdir, "repo")
+    start = time.perf_counter()
+    generate_repo(repo, spec)
+    generate_time = time.perf_counter() - start
+
+    # lib modules read the project from the command line and the database path
+    # from the environment when they are imported
+    os.environ["DB_PATH"] = os.path.join(workdir, "codebase.db")
+    # The stub embedder exercises the vector index without a running Ollama
+    os.environ.setdefault("EMBEDDING_MODEL", "stub")
+    sys.argv = [sys.argv[0], repo, "src", "--jobs", str(args.jobs)]
+    from lib.chunking import chunk_python_code, chunk_js_ts_code
+    from lib.context import get_git_tracked_files
+    import lib.db as db
+    from lib.db import init_sqlite_tables, cleanup_data
+    from lib.ingest import ingest_codebase, wait_for_embeddings, write_chunks
+    from lib.parser_worker import PARSER_PATH
+    from lib.types import FileRecord
+    from lib.vectors import search_similar_snippets
+
+    init_sqlite_tables()
+    files = get_git_tracked_files(repo)
+    python_files = [f"{repo}/{file}" for file in files if file.endswith(".py")]
+    ts_files = [f"{repo}/{file}" for file in files if file.endswith(".ts")]
+    has_typescript = typescript_available(PARSER_PATH)
+
+    def count_writes(fn):
+        """`fn` returning the rows it inserted, updated or deleted."""
+
+        def run():
+            before = db.writer.total_changes
+            fn()
+            return db.writer.total_changes - before
+
+        return run
+
+    results = []
+    chunked = []
+
+    def chunk_all(chunker, paths):
+        def run():
+            rows = 0
+            for path in paths:
+                chunks = chunker(path)
+                if chunks is None:
+                    continue
+                (snippets, dependencies) = chunks
+                chunked.append((FileRecord(path, 0, 0, ""), (snippets, dependencies)))
+                rows += len(snippets) + len(dependencies)
+            return rows
+
+        return run
+
+    results.append(
+        run_stage(
+            "chunk_python_code",
+            chunk_all(chunk_python_code, python_files),
+            len(python_files),
+        )
+    )
+    if has_typescript:
+        results.append(
+            run_stage(
+                "chunk_js_ts_code",
+                chunk_all(chunk_js_ts_code, ts_files),
+                len(ts_files),
+            )
+        )
+    else:
+        results.append(
+            {"stage": "chunk_js_ts_code", "skipped": "typescript is not installed"}
+        )
+
+    results.append(
+        run_stage("db_write", count_writes(lambda: write_chunks(chunked)), len(chunked))
+    )
+    cleanup_data(repo)
+
+    ingested_files = len(python_files) + (len(ts_files) if has_typescript else 0)
+
+    @count_writes
+    def ingest():
+        ingest_codebase(repo, "src", args.jobs)
+        # Embedding runs in the background, the stage includes it
+        wait_for_embeddings()
+
+    results.append(run_stage("ingest_codebase_full", ingest, ingested_files))
+    results.append(run_stage("ingest_codebase_noop", ingest, ingested_files))
+    for path in python_files[: args.touch]:
+        with open(path, "a") as f:
+            f.write("\n\ndef touched_by_benchmark():\n    return 1\n")
+    results.append(
+        run_stage(
+            "ingest_codebase_touched",
+            ingest,
+            min(args.touch, len(python_files)),
+        )
+    )
+
+    def search():
+        for query in ("parse the value", "json result", "model method", "os path"):
+            for _ in range(25):
+                search_similar_snippets(query, 10)
+        return 100
+
+    search_similar_snippets("warm up", 10)
+    results.append(run_stage("vector_search_x100", search, ingested_files))
+
+    report = {
+        "commit": command_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(__file__)
+        ),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "node": command_output(["node", "--version"]),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "jobs": args.jobs,
+        "spec": asdict(spec),
+        "repo": {
+            "files": len(files),
+            "bytes": sum(os.path.getsize(f"{repo}/{file}") for file in files),
+            "generate_s": round(generate_time, 4),
+        },
+        "stages": results,
+        "db_bytes": sum(
+            os.path.getsize(path)
+            for path in (os.environ["DB_PATH"], f"{os.environ['DB_PATH']}-wal")
+            if os.path.exists(path)
+        ),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.keep:
+        print(f"Work directory kept at {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
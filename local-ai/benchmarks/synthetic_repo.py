@@ -0,0 +1,144 @@
+import os
+import random
+import subprocess
+from dataclasses import dataclass
+
+
+@dataclass
+class RepoSpec:
+    python_files: int = 200
+    ts_files: int = 200
+    declarations_per_file: int = 20  # functions, classes etc. per file
+    statements_per_declaration: int = 5  # controls file size
+    import_fan_out: int = 5  # imports from other generated modules per file
+    nesting_depth: int = 3  # directory levels below the source directory
+    seed: int = 0
+
+
+def module_dirs(spec: RepoSpec, index: int):
+    """Directory parts for the `index`th file, spreading files over `nesting_depth` levels."""
+    depth = index % (spec.nesting_depth + 1)
+    return [f"pkg{(index // (d + 1)) % 4}" for d in range(depth)]
+
+
+def python_module(spec, rng, index, modules):
+    lines = [f'"""Synthetic module {index}."""', "import os", "import json"]
+    imported = []
+    for other in rng.sample(range(index), min(index, spec.import_fan_out)):
+        name = f"func_{other}_{rng.randrange(spec.declarations_per_file)}"
+        lines.append(f"from {modules[other]} import {name}")
+        imported.append(name)
+    lines.append("")
+
+    local = []
+    for d in range(spec.declarations_per_file):
+        lines.append("")
+        kind = d % 4
+        calls = rng.sample(imported, min(2, len(imported))) + local[-2:]
+        if kind == 3:
+            lines.append(f"# Class {d} of module {index}")
+            lines.append(f"class Model_{index}_{d}:")
+            lines.append(f'    """Model {d}."""')
+            lines.append("")
+            lines.append("    def __init__(self, value):")
+            lines.append("        self.value = value")
+            for s in range(spec.statements_per_declaration):
+                lines.append("")
+                lines.append(f"    def method_{s}(self, x):")
+                call = rng.choice(calls) if calls else "abs"
+                lines.append(f"        return {call}(self.value + x * {s})")
+        elif kind == 2:
+            lines.append(f"CONSTANT_{index}_{d} = {{'key': {d}, 'path': os.sep}}")
+        else:
+            name = f"func_{index}_{d}"
+            if d % 5 == 0:
+                lines.append("@staticmethod")
+            lines.append(f"def {name}(value=0):")
+            lines.append(f'    """Function {d} of module {index}."""')
+            lines.append("    result = value")
+            for s in range(spec.statements_per_declaration):
+                call = rng.choice(calls) if calls else "abs"
+                lines.append(f"    if result > {s}:  # branch {s}")
+                lines.append(f"        result = {call}(result - {s})")
+            lines.append("    return json.dumps(result)")
+            local.append(name)
+    # Make sure every name other modules import exists
+    for d in range(spec.declarations_per_file):
+        if d % 4 in (2, 3):
+            lines.append("")
+            lines.append("")
+            lines.append(f"def func_{index}_{d}(value=0):")
+            lines.append("    return value")
+    return "\n".join(lines) + "\n"
+
+
+def ts_module(spec, rng, index, paths, own_dir):
+    lines = [f"// Synthetic module {index}"]
+    imported = []
+    for other in rng.sample(range(index), min(index, spec.import_fan_out)):
+        name = f"func{other}_{rng.randrange(spec.declarations_per_file)}"
+        relative = os.path.relpath(paths[other], own_dir)
+        if not relative.startswith("."):
+            relative = f"./{relative}"
+        lines.append(f"import {{ {name} }} from '{relative}';")
+        imported.append(name)
+    lines.append("")
+
+    local = []
+    for d in range(spec.declarations_per_file):
+        lines.append("")
+        kind = d % 4
+        calls = rng.sample(imported, min(2, len(imported))) + local[-2:]
+        if kind == 0:
+            lines.append(f"export interface Shape{index}_{d} {{")
+            for s in range(spec.statements_per_declaration):
+                lines.append(f"    field{s}: number;")
+            lines.append("}")
+        elif kind == 1:
+            lines.append(f"export type Alias{index}_{d} = Shape{index}_{d - 1} | null;")
+        elif kind == 2:
+            lines.append(f"export class Service{index}_{d} {{")
+            for s in range(spec.statements_per_declaration):
+                call = rng.choice(calls) if calls else "Math.abs"
+                lines.append(f"    method{s}(x: number): number {{")
+                lines.append(f"        return {call}(x + {s});")
+                lines.append("    }")
+            lines.append("}")
+        lines.append(f"export function func{index}_{d}(value: number = 0): number {{")
+        lines.append("    let result = value;")
+        for s in range(spec.statements_per_declaration):
+            call = rng.choice(calls) if calls else "Math.abs"
+            lines.append(f"    if (result > {s}) {{ // branch {s}")
+            lines.append(f"        result = {call}(result - {s});")
+            lines.append("    }")
+        lines.append("    return result;")
+        lines.append("}")
+        local.append(f"func{index}_{d}")
+    return "\n".join(lines) + "\n"
+
+
+def generate_repo(root, spec: RepoSpec, source_directory="src"):
+    """Write a synthetic Python and TypeScript project under `root` and `git add` it."""
+    rng = random.Random(spec.seed)
+    src = os.path.join(root, source_directory)
+
+    modules = []
+    for index in range(spec.python_files):
+        parts = module_dirs(spec, index)
+        modules.append(".".join(["py", *parts, f"mod_{index}"]))
+        directory = os.path.join(src, "py", *parts)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"mod_{index}.py"), "w") as f:
+            f.write(python_module(spec, rng, index, modules))
+
+    paths = []
+    for index in range(spec.ts_files):
+        directory = os.path.join(src, "ts", *module_dirs(spec, index))
+        paths.append(os.path.join(directory, f"mod{index}"))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"mod{index}.ts"), "w") as f:
+            f.write(ts_module(spec, rng, index, paths, directory))
+
+    subprocess.run(["git", "init", "-q"], cwd=root, check=True)
+    subprocess.run(["git", "add", "-A"], cwd=root, check=True)
+    return root
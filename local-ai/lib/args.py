@@ -0,0 +1,28 @@
+import argparse
+import os
+
+parser = argparse.ArgumentParser(description="Chat with local LLMs about a codebase")
+parser.add_argument("directory", help="Project path")
+parser.add_argument(
+    "source_directory", help="Source directory path, relative to the project"
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="Number of processes used to chunk files when ingesting (default: CPU count)",
+)
+parser.add_argument(
+    "--prompt-layout",
+    choices=["stable", "recent"],
+    default="stable",
+    help="stable keeps the prompt prefix the same across turns so Ollama can reuse it, "
+    "recent puts the context next to the latest message (default: stable)",
+)
+
+args, _ = parser.parse_known_args()
+
+directory = os.path.abspath(args.directory)
+source_directory = args.source_directory
+jobs = max(1, args.jobs)
+prompt_layout = args.prompt_layout
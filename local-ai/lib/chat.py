@@ -1,22 +1,45 @@
-import json
-import os
-import tiktoken
-import sys
+import asyncio
+import threading
+import time
+from collections import OrderedDict
 import ollama
+import lib.db as db
 from lib.db import (
-    fetch_snippets_by_source,
-    fetch_snippet_by_id,
+    fetch_snippets_by_ids,
+    fetch_snippet_versions,
+    fetch_snippet_names_by_sources,
+    search_snippets,
     fetch_assistant_by_name,
     upsert_message,
-    fetch_snippet_dependencies,
 )
+from lib.graph import snippet_graph
+from lib.vectors import search_similar_snippets
+from lib.tokens import count_tokens
+from lib.packing import max_distance, pack_snippets
+from lib.models import keep_alive_value
+from lib.log import log
 from lib.context import get_git_tracked_files, get_project_dependencies
 from lib.assistants import get_assistant_prompt
+from lib.args import directory, prompt_layout
 from gradio import ChatMessage
 from dataclasses import asdict
 
-tokenizer = tiktoken.encoding_for_model("gpt-4o")
-directory = os.path.abspath(sys.argv[1])
+search_result_limit = 8
+# With the stable layout num_ctx is rounded up to this, Ollama reloads the
+# model whenever it changes
+num_ctx_step = 2048
+
+# Streams answers without holding a thread per generation
+chat_client = ollama.AsyncClient()
+
+# Rendered snippet blocks by sorted snippet ids, see render_context_snippets
+rendered_contexts: OrderedDict = OrderedDict()
+rendered_contexts_size = 32
+rendered_contexts_lock = threading.Lock()
+
+snippets_heading = "\n# Relevant snippets of project code denoted in Markdown:\n\n"
+# Part of the context budget kept free for the notes under the snippets
+notes_reserve = 48
 
 
 def sort_snippets(context_snippets):
@@ -29,7 +52,7 @@ def sort_snippets(context_snippets):
         in_degree = {file: 0 for file in files}
 
         snippets_by_id = {snippet.id: snippet for snippet in context_snippets}
-        dependencies = fetch_snippet_dependencies(context_snippets)
+        dependencies = snippet_graph.dependencies_between(list(snippets_by_id))
 
         # Process dependencies between files
         for dependency in dependencies:
@@ -82,6 +105,132 @@ def sort_snippets(context_snippets):
     return context_snippets
 
 
+def render_note(label, ids, budget):
+    """`label: id, id and N more`, with as many ids as fit in `budget` tokens."""
+    note = f"\n\n{label}: "
+    tokens = count_tokens(note) + count_tokens(f" and {len(ids)} more")
+    shown = []
+    for id in ids:
+        tokens += count_tokens(id) + 1
+        if tokens > budget:
+            break
+        shown.append(id)
+    rest = len(ids) - len(shown)
+    if not rest:
+        note += ", ".join(shown)
+    elif shown:
+        note += f"{', '.join(shown)} and {rest} more"
+    else:
+        note += f"{rest} snippets"
+    return (note, count_tokens(note))
+
+
+def render_snippets(packed, budget):
+    """The packed snippets as Markdown, with its token count.
+
+    The count is summed from the stored snippet counts instead of encoding
+    the whole block, which can be off by a token where parts join. Notes on
+    signature-only and left out snippets list as many ids as the rest of
+    `budget` allows.
+    """
+    included = {p.snippet.id: p for p in packed if p.fidelity != "omitted"}
+    snippets_prompt = snippets_heading
+    tokens = count_tokens(snippets_prompt)
+    current_source = ""
+    for snippet in sort_snippets([p.snippet for p in included.values()]):
+        if snippet.source != current_source:
+            header = f"## {snippet.source}:\n```\n"
+            if current_source:
+                header = "```\n\n" + header
+            current_source = snippet.source
+        else:
+            header = "\n"
+        snippets_prompt += f"{header}{included[snippet.id].content}\n"
+        tokens += count_tokens(header) + included[snippet.id].tokens + 1
+    if included:
+        snippets_prompt += "```"
+        tokens += 1
+    signatures = [p.snippet.id for p in packed if p.fidelity == "signature"]
+    omitted = [p.snippet.id for p in packed if p.fidelity == "omitted"]
+    remaining = budget - tokens
+    if signatures:
+        (note, note_tokens) = render_note(
+            "Only signatures are shown of",
+            signatures,
+            remaining // 2 if omitted else remaining,
+        )
+        snippets_prompt += note
+        tokens += note_tokens
+        remaining -= note_tokens
+    if omitted:
+        (note, note_tokens) = render_note(
+            "Left out to fit the context budget", omitted, remaining
+        )
+        snippets_prompt += note
+        tokens += note_tokens
+    return (snippets_prompt, tokens)
+
+
+def fetch_graph_state(ids, selected_ids):
+    """The edges and distances that order and rank these snippets."""
+    selected = set(selected_ids)
+    edges = snippet_graph.dependencies_between(list(ids))
+    distances = snippet_graph.distances(
+        list(selected), [id for id in ids if id not in selected], max_distance
+    )
+    return (
+        sorted((edge.snippet_id, edge.dependency_name) for edge in edges),
+        sorted(distances.items()),
+    )
+
+
+def render_context_snippets(ids, selected_ids, budget):
+    """Pack and render the snippets with these ids, cached.
+
+    Returns the Markdown, its token count and the packing as
+    (id, fidelity, tokens) tuples. A cached block is used as is until the
+    next index write, after which it is used as long as none of its
+    snippets moved or changed content and the edges and distances between
+    them are the same.
+    """
+    ids = tuple(dict.fromkeys(ids))
+    if not ids:
+        return ("", 0, [])
+    key = (ids, tuple(sorted(set(selected_ids))), budget)
+    version = db.index_version
+    with rendered_contexts_lock:
+        entry = rendered_contexts.get(key)
+    if entry is not None and entry[0] == version:
+        (_, _, rendered, tokens, packing) = entry
+    else:
+        versions = (
+            fetch_snippet_versions(list(ids)),
+            fetch_graph_state(ids, selected_ids),
+        )
+        if entry is not None and entry[1] == versions:
+            (_, _, rendered, tokens, packing) = entry
+        else:
+            order = {id: position for position, id in enumerate(ids)}
+            context_snippets = sorted(
+                fetch_snippets_by_ids(list(ids)),
+                key=lambda snippet: order[snippet.id],
+            )
+            packed = pack_snippets(
+                context_snippets,
+                selected_ids,
+                budget - count_tokens(snippets_heading) - notes_reserve,
+            )
+            (rendered, tokens) = render_snippets(packed, budget) if packed else ("", 0)
+            packing = [(p.snippet.id, p.fidelity, p.tokens) for p in packed]
+        entry = (version, versions, rendered, tokens, packing)
+    with rendered_contexts_lock:
+        rendered_contexts[key] = entry
+        rendered_contexts.move_to_end(key)
+        while len(rendered_contexts) > rendered_contexts_size:
+            rendered_contexts.popitem(last=False)
+    return (rendered, tokens, packing)
+
+
 def build_prompt(
     history,
     user_message,
@@ -95,7 +244,7 @@ def build_prompt(
     ]  # Ensure history is not None
     context_prompt = ""
 
-    if "Include project dependencies" in options:
+    if "Project dependencies" in options:
         (project_dependencies, dev_dependencies) = get_project_dependencies(directory)
         context_prompt += "\n# Project dependencies:\n"
         for dependency in project_dependencies:
@@ -105,81 +254,142 @@ def build_prompt(
         for dependency in dev_dependencies:
             context_prompt += f"- {dependency}\n"
 
-    if "Include file structure" in options:
+    if "File structure" in options:
         files = get_git_tracked_files(directory)
+        snippet_names = fetch_snippet_names_by_sources(
+            [
+                f"{directory}/{file}"
+                for file in files
+                if ".test." not in file and ".test-" not in file
+            ]
+        )
         context_prompt += "\n# Project structure:\n"
         for file in files:
             context_prompt += f"- {file}\n"
-            snippet_names = fetch_snippets_by_source(f"{directory}/{file}")
-            if ".test." in file or ".test-" in file:
-                continue
-            for name in snippet_names:
+            for name in snippet_names.get(f"{directory}/{file}", []):
                 context_prompt += f"  - {name}\n"
 
-    context_snippets = []
-
-    for snippet_id in set(file_reference):
-        context_snippets.append(fetch_snippet_by_id(snippet_id))
-
-    if context_snippets:
-        context_snippets = sort_snippets(context_snippets)
-        context_prompt += (
-            f"\n# Relevant snippets of project code denoted in Markdown:\n\n"
-        )
-        current_source = ""
-        for snippet in context_snippets:
-            if snippet.source != current_source:
-                if current_source:
-                    context_prompt += "```\n\n"
-                context_prompt += f"## {snippet.source}:\n```\n"
-                current_source = snippet.source
-            else:
-                context_prompt += "\n"
-            context_prompt += f"{snippet.content}\n"
-        context_prompt += "```"
-
-    user_prompt_len = len(tokenizer.encode(user_message))
-    context_prompt_len = len(tokenizer.encode(context_prompt))
-    system_prompt_with_context = get_assistant_prompt()
-    system_tokens = (
-        len(tokenizer.encode(text=system_prompt_with_context)) + context_prompt_len
+    context_ids = list(file_reference)
+
+    if "Related snippets" in options and user_message:
+        context_ids += [
+            snippet.id
+            for snippet in search_snippets(
+                user_message, search_result_limit, with_content=False
+            )
+        ]
+
+    if "Similar snippets" in options and user_message:
+        try:
+            similar = search_similar_snippets(user_message, search_result_limit)
+        except Exception as e:
+            log.warning(f"Semantic search failed: {e}")
+            similar = []
+        context_ids += [id for (id, _) in similar]
+
+    context_prompt_len = count_tokens(context_prompt)
+    (snippets_prompt, snippets_prompt_len, packing) = render_context_snippets(
+        context_ids,
+        file_reference,
+        max(0, assistant.context_budget - context_prompt_len),
     )
+    if snippets_prompt:
+        context_prompt += snippets_prompt
+        # Summed from the parts, close to but not exactly the encoded length
+        context_prompt_len += snippets_prompt_len
 
-    chat_messages = []
-    tokens_used = 0
-    if user_message:
-        chat_messages.append(ChatMessage("user", user_message, metadata=dict()))
-        tokens_used += len(tokenizer.encode(user_message))
-    if context_prompt:
-        chat_messages.append(ChatMessage("system", context_prompt, metadata=dict()))
-    for message in reversed(history):
-        message_length = len(tokenizer.encode(message.content))
-        if (
-            tokens_used + message_length <= assistant.context_limit
-            and message.metadata["title"] != "Thinking"
-        ):
-            chat_messages.append(message)
-            tokens_used += message_length
-        elif tokens_used + message_length > assistant.context_limit:
-            break
-
-    chat_messages.append(
-        ChatMessage("system", system_prompt_with_context, metadata=dict())
-    )
-    chat_messages = list(reversed(chat_messages))
+    user_prompt_len = count_tokens(user_message)
+    system_prompt_with_context = get_assistant_prompt()
+    system_tokens = count_tokens(system_prompt_with_context) + context_prompt_len
+
+    system_message = ChatMessage("system", system_prompt_with_context, metadata=dict())
+    context_message = ChatMessage("system", context_prompt, metadata=dict())
+    user_chat_message = ChatMessage("user", user_message, metadata=dict())
+    if prompt_layout == "stable":
+        chat_messages = [system_message]
+        if context_prompt:
+            chat_messages.append(context_message)
+        # Against the history limit alone, a limit that changed with the
+        # length of the user message would move the cut points
+        chat_messages += trim_history_in_blocks(history, assistant.context_limit)
+        if user_message:
+            chat_messages.append(user_chat_message)
+    else:
+        chat_messages = []
+        tokens_used = 0
+        if user_message:
+            chat_messages.append(user_chat_message)
+            tokens_used += user_prompt_len
+        if context_prompt:
+            chat_messages.append(context_message)
+        for message in reversed(history):
+            message_length = count_tokens(message.content)
+            if (
+                tokens_used + message_length <= assistant.context_limit
+                and message.metadata["title"] != "Thinking"
+            ):
+                chat_messages.append(message)
+                tokens_used += message_length
+            elif tokens_used + message_length > assistant.context_limit:
+                break
+        chat_messages.append(system_message)
+        chat_messages = list(reversed(chat_messages))
+
+    if prompt_layout == "stable":
+        # The user message comes on top of the trimmed history, and the whole
+        # prompt has to fit or Ollama cuts it from the front
+        num_ctx = (
+            system_tokens
+            + assistant.context_limit
+            + user_prompt_len
+            + assistant.response_size_limit
+        )
+        num_ctx = -(-num_ctx // num_ctx_step) * num_ctx_step
+    else:
+        num_ctx = max(
+            system_tokens + assistant.context_limit,
+            assistant.response_size_limit + context_prompt_len + user_prompt_len,
+        )
     return {
         "model": assistant.llm,
         "messages": chat_messages,
         "options": {
-            "num_ctx": max(
-                system_tokens + assistant.context_limit,
-                assistant.response_size_limit + context_prompt_len + user_prompt_len,
-            ),
+            "num_ctx": num_ctx,
             "num_predict": assistant.response_size_limit,
         },
+        "packing": packing,
+        "context_message": context_message if context_prompt else None,
+        "context_tokens": context_prompt_len,
     }
 
 
+def trim_history_in_blocks(history, limit):
+    """The latest messages fitting in `limit` tokens, in order, without thinking.
+
+    Older messages are dropped in blocks of about half the limit, at cut
+    points that stay put as the chat grows, so consecutive prompts share
+    their prefix until the next block is dropped.
+    """
+    messages = [
+        message
+        for message in history
+        if dict.get(message.metadata or {}, "title") != "Thinking"
+    ]
+    lengths = [count_tokens(message.content) for message in messages]
+    step = max(1, limit // 2)
+    total = sum(lengths)
+    start = 0
+    dropped = 0
+    boundary = 0
+    while total > limit and start < len(messages):
+        boundary += step
+        while start < len(messages) and dropped < boundary:
+            dropped += lengths[start]
+            total -= lengths[start]
+            start += 1
+    return messages[start:]
+
+
 def build_prompt_code(
     history,
     user_message,
@@ -195,8 +405,15 @@ def build_prompt_code(
         selected_assistant,
         options,
     )
+
+    def message_tokens(message):
+        # The context block isn't encoded as a whole, its parts were counted
+        if message is prompt["context_message"]:
+            return prompt["context_tokens"]
+        return count_tokens(message.content)
+
     system_message_tokens = [
-        len(tokenizer.encode(message.content))
+        message_tokens(message)
         for message in prompt["messages"]
         if message.role == "system"
     ]
@@ -204,79 +421,152 @@ def build_prompt_code(
     markdown = f"# Assistant: {assistant.name}\n"
     markdown += f"## Model: {assistant.llm}\n"
     markdown += f"## Context limit: {assistant.context_limit} + {system_prompt_len}\n"
-    markdown += f"## Response size limit: {assistant.response_size_limit}\n\n"
+    markdown += f"## Response size limit: {assistant.response_size_limit}\n"
+    markdown += f"## Context budget: {assistant.context_budget}\n\n"
+    if prompt["packing"]:
+        markdown += "| Snippet | Included as | Tokens |\n| --- | --- | --- |\n"
+        for id, fidelity, tokens in prompt["packing"]:
+            markdown += f"| {id} | {fidelity} | {tokens} |\n"
     markdown += "\n***\n\n"
     for message in prompt["messages"]:
-        token_amount = len(tokenizer.encode(text=message.content))
+        token_amount = message_tokens(message)
         markdown += f"\n# (tokens: {token_amount}) {message.role}:\n{message.content}\n\n***\n\n"
     return markdown
 
 
-def stream_chat(
+class MessageWriter:
+    """Write-behind persistence of the message being streamed.
+
+    A message is written as soon as it appears and again when the stream
+    moves on to the next one. In between, growing content is written at
+    most every `interval` seconds or `size` new characters, and `flush`
+    writes whatever is left.
+    """
+
+    def __init__(self, interval: float = 1.0, size: int = 4096):
+        self.interval = interval
+        self.size = size
+        self.message = None
+        self.ordinal = None
+        self.written = None
+        self.written_at = 0.0
+
+    def due(self, message: ChatMessage, ordinal: int) -> bool:
+        """Whether `update` with this message would write anything."""
+        return (
+            message is not self.message
+            or ordinal != self.ordinal
+            or time.monotonic() - self.written_at >= self.interval
+            or len(message.content) - len(self.written) >= self.size
+        )
+
+    def update(self, message: ChatMessage, ordinal: int):
+        if message is not self.message or ordinal != self.ordinal:
+            self.flush()
+            (self.message, self.ordinal, self.written) = (message, ordinal, None)
+            self.flush()
+        elif self.due(message, ordinal):
+            self.flush()
+
+    def flush(self):
+        if self.message is None or self.message.content == self.written:
+            return
+        upsert_message(self.message, self.ordinal)
+        self.written = self.message.content
+        self.written_at = time.monotonic()
+
+
+async def stream_chat(
     history,
     user_message,
     file_reference,
     selected_assistant,
     options,
 ):
+    """Stream the answer into `history`.
+
+    Database work runs in worker threads, so many sessions can stream on the
+    event loop at once. Cancelling the event, as the Stop button does,
+    closes the HTTP stream and with it the generation in Ollama.
+    """
     history = history or []  # Ensure history is not None
-    prompt = build_prompt(
+    prompt = await asyncio.to_thread(
+        build_prompt,
         history,
         user_message,
         file_reference,
         selected_assistant,
         options,
     )
-    assistant = fetch_assistant_by_name(selected_assistant)
-    stream = ollama.chat(
+    assistant = await asyncio.to_thread(fetch_assistant_by_name, selected_assistant)
+    started = time.monotonic()
+    stream = await chat_client.chat(
         model=assistant.llm,
         messages=[asdict(message) for message in prompt["messages"]],
         options=prompt["options"],
         stream=True,
+        keep_alive=keep_alive_value(assistant.keep_alive),
     )
     # Stream the response line by line
     bot_message = ""
     thinking = False
     first = True
-    for data in stream:
-        if first:
-            first = False
-            new_message = ChatMessage("user", user_message, dict())
-            history.append(new_message)
-            upsert_message(new_message, len(history))
-        if (data["message"]["content"]) == "<think>":
-            thinking = True
-            continue
-        if (data["message"]["content"]) == "</think>":
-            thinking = False
-            continue
-
-        if thinking:
-            if dict.get(history[-1].metadata, "title") != "Thinking":
-                new_message = ChatMessage(
-                    "assistant",
-                    bot_message,
-                    {"title": "Thinking"},
-                )
+    writer = MessageWriter()
+    try:
+        async for data in stream:
+            if first:
+                first = False
+                first_token_time = time.monotonic() - started
+                new_message = ChatMessage("user", user_message, dict())
                 history.append(new_message)
-                upsert_message(new_message, len(history))
-            bot_message += data["message"]["content"]
-            history[-1].content = bot_message
-        else:
-            if (
-                history[-1].role != "assistant"
-                or dict.get(history[-1].metadata, "title") == "Thinking"
-            ):
-                bot_message = ""
-                new_message = ChatMessage("assistant", bot_message, dict())
-                history.append(new_message)
-                upsert_message(new_message, len(history))
-            bot_message += data["message"]["content"]
-            history[-1].content = bot_message
-            upsert_message(history[-1], len(history))
-        yield history
-        if data.get("done"):
-            break
+                await asyncio.to_thread(writer.update, new_message, len(history))
+            if (data["message"]["content"]) == "<think>":
+                thinking = True
+                continue
+            if (data["message"]["content"]) == "</think>":
+                thinking = False
+                continue
+
+            if thinking:
+                if dict.get(history[-1].metadata, "title") != "Thinking":
+                    new_message = ChatMessage(
+                        "assistant",
+                        bot_message,
+                        {"title": "Thinking"},
+                    )
+                    history.append(new_message)
+                bot_message += data["message"]["content"]
+                history[-1].content = bot_message
+            else:
+                if (
+                    history[-1].role != "assistant"
+                    or dict.get(history[-1].metadata, "title") == "Thinking"
+                ):
+                    bot_message = ""
+                    new_message = ChatMessage("assistant", bot_message, dict())
+                    history.append(new_message)
+                bot_message += data["message"]["content"]
+                history[-1].content = bot_message
+            if writer.due(history[-1], len(history)):
+                await asyncio.to_thread(writer.update, history[-1], len(history))
+            yield history
+            if data.get("done"):
+                log_prompt_evaluation(data, first_token_time)
+                break
+    finally:
+        # Also runs when the stream fails or the UI cancels the generator
+        await stream.aclose()
+        await asyncio.to_thread(writer.flush)
+
+
+def log_prompt_evaluation(data, first_token_time):
+    # Tokens Ollama could not take from its cache of the previous prompt
+    evaluated = data.get("prompt_eval_count") or 0
+    duration = (data.get("prompt_eval_duration") or 0) / 1e6
+    log.info(
+        f"Prompt evaluation: {evaluated} tokens in {duration:.0f} ms, "
+        f"first token after {first_token_time * 1000:.0f} ms"
+    )
 
 
 def delete_message(chatbot):
@@ -285,7 +575,7 @@ def delete_message(chatbot):
     return chatbot
 
 
-def retry_last_message(
+async def retry_last_message(
     chatbot,
     file_reference,
     selected_assistant,
@@ -301,7 +591,7 @@ def retry_last_message(
             selected_assistant,
             options,
         )
-        for chat_history in generator:
+        async for chat_history in generator:
             yield chat_history
     else:
         yield chatbot
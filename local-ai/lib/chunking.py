@@ -1,17 +1,21 @@
 import ast
 import tokenize
 import io
-import subprocess
-import json
 import os
-import sys
+import re
+from bisect import bisect_left, bisect_right
 
+from dataclasses import astuple
 from typing import List
 from lib.types import Snippet, Dependency
 from lib.log import log
-
-directory = os.path.abspath(sys.argv[1])
-source_directory = sys.argv[2]
+from lib.parser_worker import (
+    parse_js_ts_file,
+    parse_js_ts_files,
+    ParserError,
+    ParserStartError,
+)
+from lib.args import directory, source_directory
 
 
 def read_file(filepath):
@@ -38,6 +42,42 @@ def get_comments(source):
     return comments
 
 
+def comments_between(comments, comment_lines, after_line, before_line):
+    """Comments strictly between two line numbers. `comment_lines` is sorted."""
+    return comments[
+        bisect_right(comment_lines, after_line) : bisect_left(
+            comment_lines, before_line
+        )
+    ]
+
+
+def split_lines(source):
+    """Split keeping line endings, counting lines the same way `ast` does."""
+    return re.findall(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+\Z", source)
+
+
+def source_segment(lines, node):
+    """`ast.get_source_segment` over pre-split lines, which it would re-split per call."""
+    start, end = node.lineno - 1, node.end_lineno - 1
+    if start == end:
+        return lines[start].encode()[node.col_offset : node.end_col_offset].decode()
+    first = lines[start].encode()[node.col_offset :].decode()
+    last = lines[end].encode()[: node.end_col_offset].decode()
+    return "".join([first, *lines[start + 1 : end], last])
+
+
+def dotted_name(node):
+    """`a.b.c` for an attribute chain rooted at a plain name, otherwise None."""
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return ".".join(reversed(parts))
+
+
 def resolve_relative_import(file_path, module, level):
     """
     Resolve a relative import (e.g., '.utils') to an absolute path.
@@ -69,51 +109,62 @@ def resolve_relative_import(file_path, module, level):
 
 
 def process_python_imports(
-    source_code, file_path, snippets: List[Snippet]
+    module: ast.Module, file_path, snippets: List[Snippet]
 ) -> List[Dependency]:
-    tree = ast.parse(source_code)
+    """Collect imports and name usages in one walk over the module.
+
+    Usages are attributed to the top-level snippet whose line range contains
+    them, and the file snippet gets the union of all of them.
+    """
     imports = []
+    declarations = [s for s in snippets if s.type not in ("file", "imports")]
+    starts = [s.start_line for s in declarations]
+    used_names = {s.id: set() for s in declarations}
+    file_used_names = set()
+
+    for node in ast.walk(module):
+        if isinstance(node, ast.Import):
+            # Handle 'import x as y' style
+            for alias in node.names:
+                module_name = alias.name
+                asname = alias.asname or module_name
+                imports.append({"module": module_name, "name": asname})
+            continue
+        elif isinstance(node, ast.ImportFrom):
+            # Handle 'from module import x as y' style
+            resolved_module = resolve_relative_import(
+                file_path, node.module, node.level
+            )
+            for alias in node.names:
+                imported_name = alias.name
+                asname = alias.asname or imported_name
+                imports.append({"module": resolved_module, "name": asname})
+            continue
+        elif isinstance(node, ast.Name):
+            if not isinstance(node.ctx, ast.Load):
+                continue
+            name = node.id
+        elif isinstance(node, ast.Attribute):
+            name = dotted_name(node)
+            if name is None:
+                continue
+        else:
+            continue
 
-    for node in ast.walk(tree):
-        if isinstance(node, (ast.Import, ast.ImportFrom)):
-            if isinstance(node, ast.Import):
-                # Handle 'import x as y' style
-                for alias in node.names:
-                    module_name = alias.name
-                    asname = alias.asname or module_name
-                    imports.append(
-                        {
-                            "module": module_name,
-                            "name": asname,
-                            "type": "import",
-                            "lineno": node.lineno,
-                        }
-                    )
-            elif isinstance(node, ast.ImportFrom):
-                # Handle 'from module import x as y' style
-                module = node.module
-                level = node.level
-                resolved_module = resolve_relative_import(file_path, module, level)
-                for alias in node.names:
-                    imported_name = alias.name
-                    asname = alias.asname or imported_name
-                    imports.append(
-                        {
-                            "module": resolved_module,
-                            "name": asname,
-                            "type": "from_import",
-                            "lineno": node.lineno,
-                        }
-                    )
+        file_used_names.add(name)
+        index = bisect_right(starts, node.lineno) - 1
+        if index >= 0 and node.lineno <= declarations[index].end_line:
+            used_names[declarations[index].id].add(name)
 
+    snippet_names = {s.name: s.id for s in declarations}
     dependencies: List[Dependency] = []
 
     for snippet in snippets:
         if snippet.type == "imports":
             continue
-        content = snippet.content
+        names = file_used_names if snippet.type == "file" else used_names[snippet.id]
         for imp in imports:
-            if imp["name"] in content:
+            if imp["name"] in names:
                 dependency_name = (
                     imp["name"]
                     if imp["module"] == imp["name"]
@@ -121,46 +172,14 @@ def process_python_imports(
                 )
                 dependencies.append(Dependency(snippet.id, dependency_name))
 
-    # Process internal dependencies between chunks
-    snippet_names = {s.name: s.id for s in snippets if s.type != "file"}
-
-    for current_snippet in snippets:
-        if current_snippet.type == "imports":
-            continue
-        current_id = current_snippet.id
-        content = current_snippet.content
-        tree = ast.parse(content)
-        used_names = set()
-
-        # Collect names used in function calls
-        for node in ast.walk(tree):
-            if isinstance(node, ast.Name):
-                if isinstance(node.ctx, ast.Load):
-                    used_names.add(node.id)
-            elif isinstance(node, ast.Attribute):
-                value = node.value
-                if isinstance(value, ast.Name):
-                    used_names.add(f"{value.id}.{node.attr}")
-            elif isinstance(node, ast.Call):
-                func = node.func
-                if isinstance(func, ast.Name):
-                    used_names.add(func.id)
-                elif isinstance(func, ast.Attribute):
-                    value_attr = func.value
-                    if isinstance(value_attr, ast.Name):
-                        used_names.add(f"{value_attr.id}.{func.attr}")
-
-        # Check for dependencies on other chunks
-        for name in used_names:
-            if name in snippet_names:
-                dependency_id = snippet_names[name]
-                if dependency_id != current_id:
-                    dependencies.append(Dependency(current_id, dependency_id))
-        dependencies.append(
-            Dependency(current_id, f"{current_snippet.module}._imports_")
-        )
+        # Dependencies on other chunks of the same file
+        for name in names:
+            dependency_id = snippet_names.get(name)
+            if dependency_id and dependency_id != snippet.id:
+                dependencies.append(Dependency(snippet.id, dependency_id))
+        dependencies.append(Dependency(snippet.id, f"{snippet.module}._imports_"))
 
-    return dependencies
+    return list({astuple(d): d for d in dependencies}.values())
 
 
 def chunk_python_code(source_file: str) -> (List[Snippet], List[Dependency]):
@@ -173,7 +192,7 @@ def chunk_python_code(source_file: str) -> (List[Snippet], List[Dependency]):
     )
     source_text = read_file(source_file)
     if source_text is None:
-        return
+        return None
     snippets: List[Snippet] = [
         Snippet(
             modulepath,
@@ -189,6 +208,8 @@ def chunk_python_code(source_file: str) -> (List[Snippet], List[Dependency]):
     module = ast.parse(source_text)
     top_level_nodes = module.body
     comments = get_comments(source_text)
+    comment_lines = [line for line, _ in comments]
+    source_lines = split_lines(source_text)
 
     # Process imports first
     import_nodes = [
@@ -196,14 +217,12 @@ def chunk_python_code(source_file: str) -> (List[Snippet], List[Dependency]):
     ]
     if import_nodes:
         first_import = import_nodes[0]
-        preceding_comments = [
-            (line, c) for line, c in comments if line < first_import.lineno
-        ]
-        preceding_str = "\n".join(
-            c[1] for c in sorted(preceding_comments, key=lambda x: x[0])
+        preceding_comments = comments_between(
+            comments, comment_lines, 0, first_import.lineno
         )
+        preceding_str = "\n".join(c[1] for c in preceding_comments)
         imports_code = "\n".join(
-            ast.get_source_segment(source_text, node) for node in import_nodes
+            source_segment(source_lines, node) for node in import_nodes
         )
         content = f"{preceding_str}\n{imports_code}" if preceding_str else imports_code
         start_line = first_import.lineno
@@ -235,11 +254,11 @@ def chunk_python_code(source_file: str) -> (List[Snippet], List[Dependency]):
             start_line = first_decorator.lineno
 
         # Get node code with decorators included
-        node_code = ast.get_source_segment(source_text, node)
+        node_code = source_segment(source_lines, node)
         if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.decorator_list:
             decorator_code = []
             for d in node.decorator_list:
-                decorator_code.append(ast.get_source_segment(source_text, d))
+                decorator_code.append(source_segment(source_lines, d))
             node_code = "\n".join(decorator_code) + "\n" + node_code
 
         # Calculate end_line
@@ -247,8 +266,8 @@ def chunk_python_code(source_file: str) -> (List[Snippet], List[Dependency]):
         end_line = start_line + lines - 1
 
         # Find preceding comments between previous_end and start_line
-        preceding = [c for c in comments if previous_end < c[0] < start_line]
-        preceding_str = "\n".join(c[1] for c in sorted(preceding, key=lambda x: x[0]))
+        preceding = comments_between(comments, comment_lines, previous_end, start_line)
+        preceding_str = "\n".join(c[1] for c in preceding)
 
         # Determine node name
         name = ""
@@ -288,37 +307,61 @@ def chunk_python_code(source_file: str) -> (List[Snippet], List[Dependency]):
         )
         previous_end = end_line
 
-    dependencies = process_python_imports(source_text, source_file, snippets)
+    dependencies = process_python_imports(module, source_file, snippets)
     return (snippets, dependencies)
 
 
-# Chunker for React and JS/TS files
-def chunk_js_ts_code(source_file: str) -> (List[Snippet], List[Dependency]):
-    result = subprocess.run(
-        [
-            f"node parsers/typescript/parser.js {source_file} {directory}/{source_directory}"
-        ],
-        capture_output=True,
-        shell=True,
-        text=True,
-    )
-    data = json.loads(result.stdout)
+def js_ts_records_to_chunks(records) -> (List[Snippet], List[Dependency]):
     snippets: List[Snippet] = []
     dependencies: List[Dependency] = []
-    for dict in data["chunks"]:
-        snippets.append(
-            Snippet(
-                dict["id"],
-                dict["source"],
-                dict["module"],
-                dict["name"],
-                dict["content"],
-                dict["start_line"],
-                dict["end_line"],
-                dict["type"],
+    for record in records:
+        if "chunk" in record:
+            dict = record["chunk"]
+            snippets.append(
+                Snippet(
+                    dict["id"],
+                    dict["source"],
+                    dict["module"],
+                    dict["name"],
+                    dict["content"],
+                    dict["start_line"],
+                    dict["end_line"],
+                    dict["type"],
+                )
             )
-        )
-    for dict in data["dependencies"]:
-        dependencies.append(Dependency(dict["snippet_id"], dict["dependency_name"]))
-
+        else:
+            dict = record["dependency"]
+            dependencies.append(Dependency(dict["snippet_id"], dict["dependency_name"]))
     return (snippets, dependencies)
+
+
+# Chunker for React and JS/TS files
+def chunk_js_ts_code(source_file: str) -> (List[Snippet], List[Dependency]):
+    try:
+        # Records are converted as the parser streams them
+        return js_ts_records_to_chunks(
+            parse_js_ts_file(source_file, f"{directory}/{source_directory}")
+        )
+    except ParserStartError:
+        # Already logged once by the pool
+        return None
+    except (ParserError, OSError) as e:
+        # None rather than no chunks, so the file's snippets and manifest
+        # record are kept and it is retried on the next ingest
+        log.error(f"Failed to parse file {source_file}: {e}")
+        return None
+
+
+def chunk_js_ts_files(source_files: List[str]):
+    """Chunk many JS/TS files in batches through the parser workers.
+
+    Parsing starts immediately. Returns an iterator of
+    (source_file, (snippets, dependencies)) in completion order. Files that
+    failed to parse are left out, so they keep their snippets and are retried.
+    """
+    results = parse_js_ts_files(source_files, f"{directory}/{source_directory}")
+    return (
+        (source_file, js_ts_records_to_chunks(records))
+        for source_file, records in results
+        if records is not None
+    )
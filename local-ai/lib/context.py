@@ -10,6 +10,19 @@ def get_git_tracked_files(root_dir):
     return result.stdout.splitlines()
 
 
+def filter_git_tracked_files(root_dir, files):
+    """Return the subset of `files`, relative to `root_dir`, that git tracks."""
+    if not files:
+        return []
+    result = subprocess.run(
+        ["git", "ls-files", "--", *files],
+        cwd=root_dir,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.splitlines()
+
+
 def get_project_dependencies(directory):
     files = get_git_tracked_files(directory)
     filepaths = [
@@ -1,20 +1,80 @@
+import hashlib
+import itertools
+import os
+import re
 import sqlite3
 import json
-from typing import Optional, List
-from lib.types import Assistant, Snippet, Dependency, UIState
-from gradio import ChatMessage
+import threading
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from typing import TYPE_CHECKING, Optional, List, Dict, Iterable
+from lib.types import Assistant, Snippet, Dependency, UIState, FileRecord
 from dataclasses import astuple
+from lib.log import log
+from lib.tokens import token_length, count_tokens, remember_tokens
 
-# Connect to SQLite database (or create it if it doesn't exist)
-conn = sqlite3.connect("codebase.db", check_same_thread=False, isolation_level=None)
+if TYPE_CHECKING:
+    # Imported where messages are built, so ingest workers don't load gradio
+    from gradio import ChatMessage
 
 
-def init_sqlite_tables():
-    cursor = conn.cursor()
+def connect(path: str, writer: bool = True) -> sqlite3.Connection:
+    # Only the writer is shared between threads, always under `write_lock`
+    connection = sqlite3.connect(
+        path, check_same_thread=not writer, isolation_level=None
+    )
+    if writer:
+        # WAL lets the UI read while an ingest is writing, and with it NORMAL
+        # sync is still safe against corruption
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+    else:
+        connection.execute("PRAGMA query_only = ON")
+    connection.execute("PRAGMA cache_size = -65536")  # 64 MiB
+    connection.execute("PRAGMA mmap_size = 268435456")  # 256 MiB
+    connection.execute("PRAGMA temp_store = MEMORY")
+    return connection
+
+
+# Connect to SQLite database (or create it if it doesn't exist). Writes go
+# through the one writer connection, reads through a connection per thread.
+db_path = os.getenv("DB_PATH", "codebase.db")
+writer = connect(db_path)
+write_lock = threading.RLock()
+writer_thread = None  # thread running the current transaction
+readers = threading.local()
+
+
+def read_cursor() -> sqlite3.Cursor:
+    """Cursor on the calling thread's own read connection.
+
+    Inside a transaction it is on the writer instead, so reads see the
+    transaction's own writes.
+    """
+    if writer_thread == threading.get_ident():
+        return writer.cursor()
+    connection = getattr(readers, "connection", None)
+    if connection is None:
+        connection = readers.connection = connect(db_path, writer=False)
+    return connection.cursor()
+
+
+def create_initial_schema(cursor):
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(snippets)")]
+    if columns and "key" not in columns:
+        # Snippets and edges are derived from the codebase, so tables from
+        # before integer keys are dropped and rebuilt by the next ingest
+        log.warning("Snippet tables are outdated, ingest the codebase again")
+        cursor.execute("DROP TABLE snippets")
+        cursor.execute("DROP TABLE IF EXISTS dependencies")
+        cursor.execute("DROP TABLE IF EXISTS files")
     cursor.execute(
         """
     CREATE TABLE IF NOT EXISTS snippets (
-        id TEXT PRIMARY KEY,
+        key INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
         source TEXT,
         module TEXT,
         name TEXT,
@@ -28,10 +88,35 @@ def init_sqlite_tables():
     cursor.execute(
         """
     CREATE TABLE IF NOT EXISTS dependencies (
-        snippet_id TEXT,
-        dependency_name TEXT,
-        PRIMARY KEY (snippet_id, dependency_name)
-        FOREIGN KEY (snippet_id) REFERENCES snippets (id)
+        snippet_key INTEGER NOT NULL,
+        dependency_key INTEGER NOT NULL,
+        PRIMARY KEY (snippet_key, dependency_key)
+    ) WITHOUT ROWID
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS dependencies_dependency ON dependencies (dependency_key, snippet_key)"
+    )
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS unresolved_dependencies (
+        snippet_key INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        PRIMARY KEY (snippet_key, name)
+    ) WITHOUT ROWID
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS unresolved_dependencies_name ON unresolved_dependencies (name)"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS snippets_source ON snippets (source)")
+    cursor.execute(
+        """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        mtime INTEGER,
+        size INTEGER,
+        hash TEXT
     )
     """
     )
@@ -62,138 +147,753 @@ def init_sqlite_tables():
             PRIMARY KEY (assistant_name)
         )"""
     )
-    conn.commit()
 
 
-def cleanup_data(directory: str):
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM snippets WHERE SOURCE LIKE ?", (f"{directory}%",))
+def create_snippet_module_index(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS snippets_module ON snippets (module)")
+
+
+def create_content_store(cursor):
     cursor.execute(
-        "DELETE FROM dependencies as d WHERE NOT EXISTS (SELECT 1 FROM snippets as s WHERE d.snippet_id = s.id)"
+        """
+    CREATE TABLE contents (
+        hash TEXT PRIMARY KEY,
+        data BLOB NOT NULL,
+        compressed INTEGER NOT NULL
+    )
+    """
+    )
+    # Snippet bodies move to `contents`, declarations may reference a
+    # character range of their file's body instead of a copy
+    cursor.execute(
+        """
+    CREATE TABLE snippets_new (
+        key INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        source TEXT,
+        module TEXT,
+        name TEXT,
+        content_hash TEXT,
+        content_start INTEGER,
+        content_end INTEGER,
+        start_line INTEGER,
+        end_line INTEGER,
+        type TEXT
     )
-    conn.commit()
+    """
+    )
+    rows = cursor.execute(
+        "SELECT key, id, source, module, name, content, start_line, end_line, type FROM snippets ORDER BY source"
+    ).fetchall()
+    for _, group in itertools.groupby(rows, key=lambda row: row[2]):
+        group = list(group)
+        snippets = [Snippet(*row[1:]) for row in group]
+        cursor.executemany(
+            "INSERT INTO snippets_new VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (row[0], s.id, s.source, s.module, s.name, *ref)
+                + (s.start_line, s.end_line, s.type)
+                for (row, s, ref) in zip(
+                    group, snippets, store_contents(cursor, snippets)
+                )
+            ],
+        )
+    cursor.execute("DROP TABLE snippets")
+    cursor.execute("ALTER TABLE snippets_new RENAME TO snippets")
+    cursor.execute("CREATE INDEX snippets_source ON snippets (source)")
+    cursor.execute("CREATE INDEX snippets_module ON snippets (module)")
+    cursor.execute("CREATE INDEX snippets_content_hash ON snippets (content_hash)")
 
 
-def upsert_snippet(snippet: Snippet):
-    cursor = conn.cursor()
+def create_search_index(cursor):
+    # Contentless, the text is already in `contents`. Rows are removed with
+    # the 'delete' command, which needs the indexed values, see search_rows
     cursor.execute(
         """
-                    INSERT OR REPLACE INTO snippets (id, source, module, name, content, start_line, end_line, type)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-        astuple(snippet),
+    CREATE VIRTUAL TABLE snippets_search USING fts5 (
+        name, identifiers, content, content='', tokenize='porter unicode61'
+    )
+    """
+    )
+    add_to_search_index(cursor, "1", ())
+
+
+def create_embedding_tables(cursor):
+    # Hash of each snippet's own text, which embeddings are cached by
+    cursor.execute("ALTER TABLE snippets ADD COLUMN text_hash TEXT")
+    rows = cursor.execute(
+        "SELECT key, content_hash, content_start, content_end FROM snippets"
+    ).fetchall()
+    contents = fetch_contents({row[1] for row in rows})
+    cursor.executemany(
+        "UPDATE snippets SET text_hash = ? WHERE key = ?",
+        [
+            (hash_text(contents.get(content_hash, "")[start:end]), key)
+            for (key, content_hash, start, end) in rows
+        ],
+    )
+    cursor.execute(
+        """
+    CREATE TABLE embedding_models (
+        model TEXT PRIMARY KEY,
+        dimensions INTEGER NOT NULL
+    )
+    """
+    )
+    # `row` is the vector's row in the model's matrix file, see lib.vectors
+    cursor.execute(
+        """
+    CREATE TABLE embeddings (
+        model TEXT NOT NULL,
+        hash TEXT NOT NULL,
+        row INTEGER NOT NULL,
+        PRIMARY KEY (model, hash)
+    ) WITHOUT ROWID
+    """
+    )
+
+
+def add_token_counts(cursor):
+    cursor.execute("ALTER TABLE snippets ADD COLUMN tokens INTEGER")
+    rows = cursor.execute(
+        "SELECT key, content_hash, content_start, content_end FROM snippets"
+    ).fetchall()
+    contents = fetch_contents({row[1] for row in rows})
+    cursor.executemany(
+        "UPDATE snippets SET tokens = ? WHERE key = ?",
+        [
+            (token_length(contents.get(content_hash, "")[start:end]), key)
+            for (key, content_hash, start, end) in rows
+        ],
+    )
+    cursor.execute("ALTER TABLE messages ADD COLUMN tokens INTEGER")
+    rows = cursor.execute("SELECT ordinal, content FROM messages").fetchall()
+    cursor.executemany(
+        "UPDATE messages SET tokens = ? WHERE ordinal = ?",
+        [(token_length(content), ordinal) for (ordinal, content) in rows],
+    )
+
+
+def add_context_budget(cursor):
+    cursor.execute(
+        "ALTER TABLE assistants ADD COLUMN context_budget INTEGER NOT NULL DEFAULT 8000"
     )
-    conn.commit()
 
 
-def upsert_dependency(dependency: Dependency):
-    cursor = conn.cursor()
+def add_keep_alive(cursor):
     cursor.execute(
-        "INSERT OR REPLACE INTO dependencies (snippet_id, dependency_name) VALUES (?, ?)",
-        astuple(dependency),
+        "ALTER TABLE assistants ADD COLUMN keep_alive TEXT NOT NULL DEFAULT '5m'"
+    )
+
+
+# Append new migrations here, never edit or reorder the ones already released
+MIGRATIONS = [
+    create_initial_schema,
+    create_snippet_module_index,
+    create_content_store,
+    create_search_index,
+    create_embedding_tables,
+    add_token_counts,
+    add_context_budget,
+    add_keep_alive,
+]
+
+
+def init_sqlite_tables():
+    """Bring the database up to the latest schema version."""
+    with transaction() as cursor:
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"
+        )
+        row = cursor.execute("SELECT version FROM schema_version").fetchone()
+        version = row[0] if row else 0
+        if version > len(MIGRATIONS):
+            log.warning(
+                f"Database schema version {version} is newer than this code supports"
+            )
+            return
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            log.info(f"Migrating database to schema version {number}")
+            migration(cursor)
+        if version < len(MIGRATIONS):
+            cursor.execute("DELETE FROM schema_version")
+            cursor.execute(
+                "INSERT INTO schema_version (version) VALUES (?)", (len(MIGRATIONS),)
+            )
+
+
+# Every committed write to snippets or edges bumps `index_version` and records
+# the sources it touched (None when it may have touched any), so in-memory
+# caches can catch up with only what changed
+index_version = 0
+index_changes = deque(maxlen=256)
+pending_index_changes = []
+index_lock = threading.Lock()
+
+
+def mark_index_changed(sources: Optional[Iterable[str]]):
+    with index_lock:
+        pending_index_changes.append(
+            frozenset(sources) if sources is not None else None
+        )
+
+
+def publish_index_changes(committed: bool):
+    global index_version
+    with index_lock:
+        if committed and pending_index_changes:
+            if None in pending_index_changes:
+                sources = None
+            else:
+                sources = frozenset().union(*pending_index_changes)
+            index_version += 1
+            index_changes.append((index_version, sources))
+        pending_index_changes.clear()
+
+
+@contextmanager
+def transaction():
+    """Run the enclosed writes in one explicit transaction on the writer.
+
+    Transactions of different threads run one after the other. Nested uses
+    join the outermost transaction, which commits once at the end.
+    """
+    global writer_thread
+    with write_lock:
+        cursor = writer.cursor()
+        if writer.in_transaction:
+            yield cursor
+            return
+        cursor.execute("BEGIN IMMEDIATE")
+        writer_thread = threading.get_ident()
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            publish_index_changes(committed=False)
+            raise
+        else:
+            cursor.execute("COMMIT")
+            publish_index_changes(committed=True)
+        finally:
+            writer_thread = None
+
+
+COMPRESS_MIN_SIZE = 1024  # bytes, smaller bodies are stored as is
+
+SNIPPET_COLUMNS = "s.id, s.source, s.module, s.name, s.start_line, s.end_line, s.type, s.content_hash, s.content_start, s.content_end, s.tokens"
+
+
+def hash_text(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def line_offsets(text: str) -> List[int]:
+    return [0] + [match.end() for match in re.finditer("\n", text)]
+
+
+def find_in_file(text: str, offsets: List[int], snippet: Snippet) -> int:
+    """Offset of the snippet's content within its file's text, or -1.
+
+    Only the lines around the snippet are searched. Leading comments may
+    put the content a few lines above `start_line`.
+    """
+    extra_lines = max(
+        snippet.content.count("\n") - (snippet.end_line - snippet.start_line), 0
+    )
+    first = max(snippet.start_line - 2 - extra_lines, 0)
+    if first >= len(offsets):
+        return -1
+    stop = (
+        offsets[snippet.end_line + 1]
+        if snippet.end_line + 1 < len(offsets)
+        else len(text)
     )
-    conn.commit()
+    return text.find(snippet.content, offsets[first], stop)
+
 
+def store_contents(cursor, snippets: List[Snippet]):
+    """Store the snippets' bodies by hash, returning (hash, start, end) for each.
+
+    Snippets whose content is a slice of their file snippet's body reference it
+    by character range instead of storing a copy, `start` and `end` are None
+    otherwise.
+    """
+    files = {}
+    for snippet in snippets:
+        if snippet.type == "file":
+            files[snippet.source] = (
+                hash_text(snippet.content),
+                snippet.content,
+                line_offsets(snippet.content),
+            )
+    bodies = {}
+    refs = []
+    for snippet in snippets:
+        file = files.get(snippet.source)
+        if file is not None and snippet.type != "file":
+            (file_hash, text, offsets) = file
+            start = find_in_file(text, offsets, snippet)
+            if start != -1:
+                bodies[file_hash] = text
+                refs.append((file_hash, start, start + len(snippet.content)))
+                continue
+        content_hash = hash_text(snippet.content)
+        bodies[content_hash] = snippet.content
+        refs.append((content_hash, None, None))
 
-def fetch_dependencies(snippet_id: str) -> List[Snippet]:
-    cursor = conn.cursor()
     cursor.execute(
-        "SELECT s.id, s.source, s.module, s.name, s.content, s.start_line, s.end_line, s.type FROM dependencies d INNER JOIN snippets s ON s.id = d.dependency_name WHERE d.snippet_id = ?",
-        (snippet_id,),
+        "SELECT hash FROM contents WHERE hash IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(bodies)),),
+    )
+    for (content_hash,) in cursor.fetchall():
+        del bodies[content_hash]
+    rows = []
+    for content_hash, text in bodies.items():
+        data = text.encode("utf-8")
+        if len(data) >= COMPRESS_MIN_SIZE:
+            rows.append((content_hash, zlib.compress(data), 1))
+        else:
+            rows.append((content_hash, data, 0))
+    cursor.executemany(
+        "INSERT INTO contents (hash, data, compressed) VALUES (?, ?, ?)", rows
     )
-    return [Snippet(*row) for row in cursor.fetchall()]
+    return refs
 
 
-def fetch_dependents(snippet_id: str) -> List[Dependency]:
-    cursor = conn.cursor()
+def fetch_contents(hashes: Iterable[str]) -> Dict[str, str]:
+    cursor = read_cursor()
     cursor.execute(
-        "SELECT d.snippet_id, d.dependency_name FROM dependencies d INNER JOIN snippets s ON s.id = d.snippet_id WHERE dependency_name = ? AND s.type != 'file'",
-        (snippet_id,),
+        "SELECT hash, data, compressed FROM contents WHERE hash IN (SELECT value FROM json_each(?))",
+        (json.dumps(list(hashes)),),
     )
-    return [Dependency(*row) for row in cursor.fetchall()]
+    return {
+        content_hash: (zlib.decompress(data) if compressed else data).decode("utf-8")
+        for (content_hash, data, compressed) in cursor.fetchall()
+    }
+
+
+def fetch_content(content_hash: str, start: Optional[int], end: Optional[int]) -> str:
+    return fetch_contents([content_hash]).get(content_hash, "")[start:end]
+
+
+def snippets_from_rows(rows, with_content: bool = False) -> List[Snippet]:
+    """Build snippets from rows of SNIPPET_COLUMNS.
+
+    Content is read on first access, or for all of them at once with
+    `with_content`, so bodies shared by several snippets are decoded once.
+    """
+    contents = fetch_contents({row[7] for row in rows}) if with_content else {}
+    snippets = []
+    for id, source, module, name, start_line, end_line, type, *ref in rows:
+        (content_hash, start, end, tokens) = ref
+        snippet = Snippet(
+            id, source, module, name, None, start_line, end_line, type, tokens
+        )
+        if with_content:
+            snippet.content = contents.get(content_hash, "")[start:end]
+        else:
+            snippet.load_content = partial(fetch_content, content_hash, start, end)
+        snippets.append(snippet)
+    return snippets
+
+
+# Whole files and import blocks would only repeat the declarations
+UNSEARCHED_TYPES = ("file", "imports")
+# Bound one parameter per type, as in `type NOT IN ({UNSEARCHED_PLACEHOLDERS})`
+UNSEARCHED_PLACEHOLDERS = ", ".join("?" for _ in UNSEARCHED_TYPES)
+
+# bm25 weights of the name, identifiers and content columns
+SEARCH_WEIGHTS = (10.0, 5.0, 1.0)
+
+
+def identifier_words(text: str) -> List[str]:
+    """Split camelCase and PascalCase identifiers in `text` into words.
+
+    The tokenizer already splits snake_case, this lets "user message" match
+    `getUserMessage` too.
+    """
+    words = {}
+    for identifier in re.findall(r"[A-Za-z][A-Za-z0-9]*", text):
+        parts = re.findall(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+", identifier)
+        if len(parts) > 1:
+            words.update(dict.fromkeys(part.lower() for part in parts))
+    return list(words)
+
+
+def search_rows(cursor, condition: str, parameters):
+    """(key, name, identifiers, content) to index for the matching snippets.
+
+    Derived only from stored columns, so deleting from the contentless index
+    later repeats exactly the values that were inserted.
+    """
+    cursor.execute(
+        f"""
+            SELECT key, name, module, content_hash, content_start, content_end
+            FROM snippets
+            WHERE type NOT IN ({UNSEARCHED_PLACEHOLDERS}) AND {condition}
+        """,
+        (*UNSEARCHED_TYPES, *parameters),
+    )
+    rows = cursor.fetchall()
+    contents = fetch_contents({row[3] for row in rows})
+    indexed = []
+    for key, name, module, content_hash, start, end in rows:
+        content = contents.get(content_hash, "")[start:end]
+        identifiers = " ".join(identifier_words(f"{name} {module} {content}"))
+        indexed.append((key, name or "", f"{module} {identifiers}", content))
+    return indexed
+
+
+def add_to_search_index(cursor, condition: str, parameters):
+    cursor.executemany(
+        "INSERT INTO snippets_search (rowid, name, identifiers, content) VALUES (?, ?, ?, ?)",
+        search_rows(cursor, condition, parameters),
+    )
+
+
+def remove_from_search_index(cursor, condition: str, parameters):
+    cursor.executemany(
+        "INSERT INTO snippets_search (snippets_search, rowid, name, identifiers, content) VALUES ('delete', ?, ?, ?, ?)",
+        search_rows(cursor, condition, parameters),
+    )
+
+
+def search_snippets(
+    query: str, limit: int = 10, with_content: bool = True
+) -> List[Snippet]:
+    """Snippets best matching the words of `query`, ranked by BM25."""
+    words = re.findall(r"\w+", query.lower()) + identifier_words(query)
+    # Quoted and OR-ed, so any text is a valid query and a snippet does not
+    # need to contain every word
+    terms = " OR ".join(f'"{word}"' for word in list(dict.fromkeys(words))[:32])
+    if not terms:
+        return []
+    cursor = read_cursor()
+    cursor.execute(
+        f"""
+            SELECT {SNIPPET_COLUMNS}
+            FROM snippets_search JOIN snippets s ON s.key = snippets_search.rowid
+            WHERE snippets_search MATCH ?
+            ORDER BY bm25(snippets_search, ?, ?, ?)
+            LIMIT ?
+        """,
+        (terms, *SEARCH_WEIGHTS, limit),
+    )
+    return snippets_from_rows(cursor.fetchall(), with_content)
+
+
+def delete_snippets_where(cursor, condition: str, parameters):
+    """Delete the snippets matching `condition` along with their edges.
+
+    Edges pointing at them from other snippets go back to
+    `unresolved_dependencies`, so they are restored once the names reappear.
+    """
+    cursor.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS deleted_snippets (key INTEGER PRIMARY KEY)"
+    )
+    cursor.execute("DELETE FROM deleted_snippets")
+    cursor.executemany(
+        f"INSERT OR IGNORE INTO deleted_snippets SELECT key FROM snippets WHERE {condition}",
+        parameters,
+    )
+    cursor.execute(
+        """
+            INSERT OR IGNORE INTO unresolved_dependencies (snippet_key, name)
+            SELECT d.snippet_key, s.id
+            FROM deleted_snippets k
+            JOIN dependencies d ON d.dependency_key = k.key
+            JOIN snippets s ON s.key = k.key
+            WHERE d.snippet_key NOT IN deleted_snippets
+        """
+    )
+    cursor.execute("DELETE FROM dependencies WHERE snippet_key IN deleted_snippets")
+    cursor.execute("DELETE FROM dependencies WHERE dependency_key IN deleted_snippets")
+    cursor.execute(
+        "DELETE FROM unresolved_dependencies WHERE snippet_key IN deleted_snippets"
+    )
+    remove_from_search_index(cursor, "key IN deleted_snippets", ())
+    cursor.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS deleted_contents (hash TEXT PRIMARY KEY)"
+    )
+    cursor.execute("DELETE FROM deleted_contents")
+    cursor.execute(
+        "INSERT OR IGNORE INTO deleted_contents SELECT content_hash FROM snippets WHERE key IN deleted_snippets"
+    )
+    cursor.execute("DELETE FROM snippets WHERE key IN deleted_snippets")
+    cursor.execute(
+        """
+            DELETE FROM contents
+            WHERE hash IN deleted_contents
+            AND NOT EXISTS (SELECT 1 FROM snippets WHERE content_hash = contents.hash)
+        """
+    )
+
+
+def directory_range(directory: str):
+    """Bounds of the paths below `directory`, for range scans on an index.
+
+    Unlike `LIKE 'directory%'` this can use an index, and does not match
+    sibling directories that share the prefix.
+    """
+    prefix = directory.rstrip("/") + "/"
+    # "0" is the character right after "/"
+    return (prefix, prefix[:-1] + "0")
+
+
+def cleanup_data(directory: str):
+    with transaction() as cursor:
+        mark_index_changed(None)
+        delete_snippets_where(
+            cursor, "source >= ? AND source < ?", [directory_range(directory)]
+        )
+        cursor.execute(
+            "DELETE FROM files WHERE path >= ? AND path < ?",
+            directory_range(directory),
+        )
+
+
+def delete_snippets_by_sources(sources: List[str]):
+    with transaction() as cursor:
+        mark_index_changed(sources)
+        delete_snippets_where(cursor, "source = ?", [(source,) for source in sources])
+
+
+def delete_file_data(paths: List[str]):
+    with transaction() as cursor:
+        delete_snippets_by_sources(paths)
+        cursor.executemany(
+            "DELETE FROM files WHERE path = ?", [(path,) for path in paths]
+        )
+
+
+def upsert_file_records_bulk(records: List[FileRecord]):
+    with transaction() as cursor:
+        cursor.executemany(
+            "INSERT OR REPLACE INTO files (path, mtime, size, hash) VALUES (?, ?, ?, ?)",
+            [astuple(record) for record in records],
+        )
+
+
+def fetch_file_records(directory: str) -> Dict[str, FileRecord]:
+    cursor = read_cursor()
+    cursor.execute(
+        "SELECT path, mtime, size, hash FROM files WHERE path >= ? AND path < ?",
+        directory_range(directory),
+    )
+    return {row[0]: FileRecord(*row) for row in cursor.fetchall()}
+
+
+def fetch_file_records_by_paths(paths: List[str]) -> Dict[str, FileRecord]:
+    cursor = read_cursor()
+    cursor.execute(
+        "SELECT path, mtime, size, hash FROM files WHERE path IN (%s)"
+        % ",".join("?" for _ in paths),
+        paths,
+    )
+    return {row[0]: FileRecord(*row) for row in cursor.fetchall()}
+
+
+def upsert_snippets_bulk(snippets: List[Snippet]):
+    # Updating in place keeps the integer key, and with it the edges, stable
+    with transaction() as cursor:
+        mark_index_changed({snippet.source for snippet in snippets})
+        ids = (json.dumps([snippet.id for snippet in snippets]),)
+        remove_from_search_index(cursor, "id IN (SELECT value FROM json_each(?))", ids)
+        refs = store_contents(cursor, snippets)
+        cursor.executemany(
+            """
+                    INSERT INTO snippets (id, source, module, name, content_hash, content_start, content_end, text_hash, tokens, start_line, end_line, type)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        source = excluded.source,
+                        module = excluded.module,
+                        name = excluded.name,
+                        content_hash = excluded.content_hash,
+                        content_start = excluded.content_start,
+                        content_end = excluded.content_end,
+                        text_hash = excluded.text_hash,
+                        tokens = excluded.tokens,
+                        start_line = excluded.start_line,
+                        end_line = excluded.end_line,
+                        type = excluded.type
+                """,
+            [
+                (
+                    s.id,
+                    s.source,
+                    s.module,
+                    s.name,
+                    *ref,
+                    hash_text(s.content),
+                    # Counted by the chunkers, left NULL and counted on first
+                    # use otherwise, never while holding the write lock
+                    s.tokens,
+                    s.start_line,
+                    s.end_line,
+                    s.type,
+                )
+                for (s, ref) in zip(snippets, refs)
+            ],
+        )
+        add_to_search_index(cursor, "id IN (SELECT value FROM json_each(?))", ids)
+
+
+def upsert_dependencies_bulk(dependencies: List[Dependency]):
+    """Store edges between snippet keys, and names that match no snippet yet
+    in `unresolved_dependencies`."""
+    rows = [astuple(dependency) for dependency in dependencies]
+    with transaction() as cursor:
+        cursor.execute(
+            "SELECT DISTINCT source FROM snippets WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps([dependency.snippet_id for dependency in dependencies]),),
+        )
+        mark_index_changed([row[0] for row in cursor.fetchall()])
+        cursor.executemany(
+            """
+                INSERT OR IGNORE INTO dependencies (snippet_key, dependency_key)
+                SELECT s.key, t.key FROM snippets s, snippets t
+                WHERE s.id = ? AND t.id = ?
+            """,
+            rows,
+        )
+        cursor.executemany(
+            """
+                INSERT OR IGNORE INTO unresolved_dependencies (snippet_key, name)
+                SELECT s.key, ?2 FROM snippets s
+                WHERE s.id = ?1 AND NOT EXISTS (SELECT 1 FROM snippets t WHERE t.id = ?2)
+            """,
+            rows,
+        )
+
+
+def resolve_dependencies(sources: List[str]):
+    """Turn unresolved names that now match snippets of `sources` into edges."""
+    with transaction() as cursor:
+        mark_index_changed(sources)
+        for source in sources:
+            cursor.execute(
+                """
+                    INSERT OR IGNORE INTO dependencies (snippet_key, dependency_key)
+                    SELECT u.snippet_key, s.key
+                    FROM snippets s JOIN unresolved_dependencies u ON u.name = s.id
+                    WHERE s.source = ?
+                """,
+                (source,),
+            )
+            cursor.execute(
+                """
+                    DELETE FROM unresolved_dependencies
+                    WHERE name IN (SELECT id FROM snippets WHERE source = ?)
+                """,
+                (source,),
+            )
 
 
 def fetch_snippets_by_directory(directory: str) -> List[Snippet]:
-    cursor = conn.cursor()
+    cursor = read_cursor()
     cursor.execute(
-        "SELECT id, source, module, name, content, start_line, end_line, type FROM snippets WHERE source LIKE ? ORDER BY id",
-        (f"{directory}%",),
+        f"SELECT {SNIPPET_COLUMNS} FROM snippets s WHERE source >= ? AND source < ? ORDER BY id",
+        directory_range(directory),
     )
-    return [Snippet(*row) for row in cursor.fetchall()]
+    return snippets_from_rows(cursor.fetchall())
 
 
-def fetch_snippets_by_source(source: str) -> List[Snippet]:
-    cursor = conn.cursor()
+def fetch_snippets_by_ids(ids: List[str], with_content: bool = True) -> List[Snippet]:
+    # The ids go in as one JSON array, so there is no bound-parameter limit
+    cursor = read_cursor()
     cursor.execute(
-        "SELECT id, source, module, name, content, start_line, end_line, type FROM snippets WHERE source = ? AND name IS NOT NULL and name != '_imports_' ORDER BY name",
-        (source,),
+        f"SELECT {SNIPPET_COLUMNS} FROM snippets s WHERE id IN (SELECT value FROM json_each(?))",
+        (json.dumps(ids),),
     )
-    return [Snippet(*row) for row in cursor.fetchall()]
+    return snippets_from_rows(cursor.fetchall(), with_content)
 
 
-def fetch_snippet_by_id(id: str) -> Optional[Snippet]:
-    cursor = conn.cursor()
+def fetch_snippet_versions(ids: List[str]) -> List[tuple]:
+    """(id, source, start_line, text_hash) of the snippets, ordered by id."""
+    cursor = read_cursor()
     cursor.execute(
-        "SELECT id, source, module, name, content, start_line, end_line, type FROM snippets WHERE id = ?",
-        (id,),
+        "SELECT id, source, start_line, text_hash FROM snippets WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id",
+        (json.dumps(ids),),
     )
-    snippet = cursor.fetchone()
-    return Snippet(*snippet)
+    return cursor.fetchall()
 
 
-def load_chat_history() -> List[ChatMessage]:
-    cursor = conn.cursor()
-    cursor.execute("SELECT role, content, metadata FROM messages ORDER BY ordinal")
-    return [
-        ChatMessage(row[0], row[1], json.loads(row[2])) for row in cursor.fetchall()
-    ]
+def fetch_snippet_names_by_sources(sources: List[str]) -> Dict[str, List[str]]:
+    cursor = read_cursor()
+    cursor.execute(
+        "SELECT source, name FROM snippets WHERE source IN (SELECT value FROM json_each(?)) AND name IS NOT NULL and name != '_imports_' ORDER BY source, name",
+        (json.dumps(sources),),
+    )
+    names = {}
+    for source, name in cursor.fetchall():
+        names.setdefault(source, []).append(name)
+    return names
+
 
+def load_chat_history() -> List["ChatMessage"]:
+    from gradio import ChatMessage
 
-def upsert_message(message: ChatMessage, ordinal: int):
-    cursor = conn.cursor()
+    cursor = read_cursor()
     cursor.execute(
-        "INSERT OR REPLACE INTO messages (ordinal, role, content, metadata) VALUES (?, ?, ?, ?)",
-        (ordinal, message.role, message.content, json.dumps(message.metadata)),
+        "SELECT role, content, metadata, tokens FROM messages ORDER BY ordinal"
     )
-    conn.commit()
+    messages = []
+    for role, content, metadata, tokens in cursor.fetchall():
+        # Later prompts count these messages without encoding them again
+        remember_tokens(content, tokens)
+        messages.append(ChatMessage(role, content, json.loads(metadata)))
+    return messages
+
+
+def upsert_message(message: "ChatMessage", ordinal: int):
+    tokens = count_tokens(message.content)
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO messages (ordinal, role, content, metadata, tokens) VALUES (?, ?, ?, ?, ?)",
+            (
+                ordinal,
+                message.role,
+                message.content,
+                json.dumps(message.metadata),
+                tokens,
+            ),
+        )
 
 
 def clear_chat_history():
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM messages")
-    conn.commit()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM messages")
 
 
 def upsert_assistant(assistant: Assistant):
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-                    INSERT OR REPLACE INTO assistants (name, llm, context_limit, response_size_limit, prompt)
-                    VALUES (?, ?, ?, ?, ?)
-                """,
-        astuple(assistant),
-    )
-    conn.commit()
+    with transaction() as cursor:
+        cursor.execute(
+            """
+                        INSERT OR REPLACE INTO assistants (name, llm, context_limit, response_size_limit, prompt, context_budget, keep_alive)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+            astuple(assistant),
+        )
 
 
 def delete_assistant(name: str):
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM assistants WHERE name = ?", (name,))
-    conn.commit()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM assistants WHERE name = ?", (name,))
 
 
 def fetch_all_assistants() -> List[Assistant]:
-    cursor = conn.cursor()
+    cursor = read_cursor()
     cursor.execute(
-        "SELECT name, llm, context_limit, response_size_limit, prompt FROM assistants"
+        "SELECT name, llm, context_limit, response_size_limit, prompt, context_budget, keep_alive FROM assistants"
     )
     return [Assistant(*row) for row in cursor.fetchall()]
 
 
 def fetch_assistant_by_name(name: str) -> Optional[Assistant]:
-    cursor = conn.cursor()
+    cursor = read_cursor()
     cursor.execute(
-        "SELECT name, llm, context_limit, response_size_limit, prompt FROM assistants WHERE name = ?",
+        "SELECT name, llm, context_limit, response_size_limit, prompt, context_budget, keep_alive FROM assistants WHERE name = ?",
         (name,),
     )
     row = cursor.fetchone()
@@ -203,24 +903,23 @@ def fetch_assistant_by_name(name: str) -> Optional[Assistant]:
 
 
 def upsert_ui_state(ui_state: UIState):
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM ui_state")
-    cursor.execute(
-        """
-            INSERT OR REPLACE INTO ui_state (assistant_name, extra_content_options, selected_snippets)
-            VALUES (?, ?, ?)
-        """,
-        (
-            ui_state.assistant_name,
-            json.dumps(ui_state.extra_content_options),
-            json.dumps(ui_state.selected_snippets),
-        ),
-    )
-    conn.commit()
+    with transaction() as cursor:
+        cursor.execute("DELETE FROM ui_state")
+        cursor.execute(
+            """
+                INSERT OR REPLACE INTO ui_state (assistant_name, extra_content_options, selected_snippets)
+                VALUES (?, ?, ?)
+            """,
+            (
+                ui_state.assistant_name,
+                json.dumps(ui_state.extra_content_options),
+                json.dumps(ui_state.selected_snippets),
+            ),
+        )
 
 
 def fetch_ui_state() -> Optional[UIState]:
-    cursor = conn.cursor()
+    cursor = read_cursor()
     cursor.execute(
         "SELECT assistant_name, extra_content_options, selected_snippets FROM ui_state"
     )
@@ -232,17 +931,3 @@ def fetch_ui_state() -> Optional[UIState]:
             selected_snippets=json.loads(state[2]),
         )
     return None
-
-
-def fetch_snippet_dependencies(snippets: List[Snippet]) -> List[Dependency]:
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-            SELECT snippet_id, dependency_name
-            FROM dependencies
-            WHERE snippet_id IN (%s)
-        """
-        % ",".join("?" for _ in snippets),
-        [s.id for s in snippets],
-    )
-    return [Dependency(*row) for row in cursor.fetchall()]
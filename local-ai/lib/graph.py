@@ -0,0 +1,213 @@
+import json
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import lib.db as db
+from lib.log import log
+from lib.types import Dependency
+
+
+class SnippetGraph:
+    """In-memory copy of the snippet ids, sources, types and edges.
+
+    It is loaded on first use. Afterwards every query first catches up with
+    `lib.db.index_changes`, reloading only the sources written since.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.loaded = False
+        self.version = 0
+        self.keys: Dict[str, int] = {}
+        self.nodes: Dict[int, Tuple[str, str, str]] = {}  # key -> (id, source, type)
+        self.by_source: Dict[str, Set[int]] = {}
+        self.dependencies: Dict[int, Set[int]] = {}
+        self.dependents: Dict[int, Set[int]] = {}
+
+    def add_node(self, key, id, source, type):
+        if key in self.nodes:
+            # Snippet ids keep their key when they move to another source
+            self.by_source[self.nodes[key][1]].discard(key)
+        self.keys[id] = key
+        self.nodes[key] = (id, source, type)
+        self.by_source.setdefault(source, set()).add(key)
+
+    def add_edge(self, snippet_key, dependency_key):
+        self.dependencies.setdefault(snippet_key, set()).add(dependency_key)
+        self.dependents.setdefault(dependency_key, set()).add(snippet_key)
+
+    def remove_node(self, key):
+        (id, source, _) = self.nodes.pop(key)
+        if self.keys.get(id) == key:
+            del self.keys[id]
+        self.by_source[source].discard(key)
+        for dependency in self.dependencies.pop(key, ()):
+            self.dependents[dependency].discard(key)
+        for dependent in self.dependents.pop(key, ()):
+            self.dependencies[dependent].discard(key)
+
+    def load(self):
+        self.reset()
+        cursor = db.read_cursor()
+        cursor.execute("SELECT key, id, source, type FROM snippets")
+        for row in cursor:
+            self.add_node(*row)
+        cursor.execute("SELECT snippet_key, dependency_key FROM dependencies")
+        for row in cursor:
+            self.add_edge(*row)
+        self.loaded = True
+        log.debug(f"Loaded snippet graph with {len(self.nodes)} snippets")
+
+    def reload_sources(self, sources):
+        # Every edge a write adds or removes touches a snippet of a source it
+        # marked, so replacing those snippets with all their edges is enough
+        for source in sources:
+            for key in list(self.by_source.get(source, ())):
+                self.remove_node(key)
+        cursor = db.read_cursor()
+        cursor.execute(
+            "SELECT key, id, source, type FROM snippets WHERE source IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(sources)),),
+        )
+        keys = []
+        for row in cursor.fetchall():
+            self.add_node(*row)
+            keys.append(row[0])
+        cursor.execute(
+            """
+                SELECT snippet_key, dependency_key FROM dependencies
+                WHERE snippet_key IN (SELECT value FROM json_each(:keys))
+                UNION
+                SELECT snippet_key, dependency_key FROM dependencies
+                WHERE dependency_key IN (SELECT value FROM json_each(:keys))
+            """,
+            {"keys": json.dumps(keys)},
+        )
+        for row in cursor:
+            self.add_edge(*row)
+
+    def sync(self):
+        with db.index_lock:
+            version = db.index_version
+            changes = [
+                change for change in db.index_changes if change[0] > self.version
+            ]
+        if self.loaded and version == self.version:
+            return
+        # Fall back to a full load when changes were dropped from the log or
+        # touched unknown sources
+        if (
+            not self.loaded
+            or not changes
+            or changes[0][0] != self.version + 1
+            or any(sources is None for (_, sources) in changes)
+        ):
+            self.load()
+        else:
+            self.reload_sources(frozenset().union(*(s for (_, s) in changes)))
+        self.version = version
+
+    def closure(
+        self,
+        snippet_id: str,
+        direction: str = "dependencies",
+        max_depth: Optional[int] = None,
+        same_source: bool = False,
+        types: Sequence[str] = (),
+        exclude_types: Sequence[str] = (),
+        limit: int = 1000,
+    ) -> List[str]:
+        """Ids of the snippets reachable from `snippet_id`, itself included.
+
+        Nearest snippets come first. `direction` is "dependencies" or
+        "dependents". Snippets whose type is in `exclude_types` are skipped.
+        With `same_source` or `types`, only snippets from the source of
+        `snippet_id` or of one of `types` are kept. Skipped snippets are not
+        traversed any further.
+        """
+        with self.lock:
+            self.sync()
+            if direction == "dependencies":
+                edges = self.dependencies
+            elif direction == "dependents":
+                edges = self.dependents
+            else:
+                raise ValueError(f"Unknown direction {direction}")
+            root = self.keys.get(snippet_id)
+            if root is None or limit < 1:
+                return []
+            root_source = self.nodes[root][1]
+
+            def keep(key):
+                (_, source, type) = self.nodes[key]
+                if type in exclude_types:
+                    return False
+                if not same_source and not types:
+                    return True
+                return (same_source and source == root_source) or type in types
+
+            visited = {root}
+            result = [snippet_id]
+            queue = deque([(root, 0)])
+            while queue:
+                (key, depth) = queue.popleft()
+                if max_depth is not None and depth >= max_depth:
+                    continue
+                for next in edges.get(key, ()):
+                    if next in visited or not keep(next):
+                        continue
+                    visited.add(next)
+                    result.append(self.nodes[next][0])
+                    if len(result) >= limit:
+                        return result
+                    queue.append((next, depth + 1))
+            return result
+
+    def distances(
+        self, seed_ids: List[str], target_ids: List[str], max_depth: int = 3
+    ) -> Dict[str, int]:
+        """Hops from the nearest seed to each target, following edges both ways.
+
+        Targets further than `max_depth` hops are left out.
+        """
+        with self.lock:
+            self.sync()
+            seeds = {self.keys[id] for id in seed_ids if id in self.keys}
+            targets = {self.keys[id] for id in target_ids if id in self.keys}
+            found = {key: 0 for key in seeds & targets}
+            visited = set(seeds)
+            frontier = list(seeds)
+            for depth in range(1, max_depth + 1):
+                if len(found) == len(targets) or not frontier:
+                    break
+                next_frontier = []
+                for key in frontier:
+                    for edges in (self.dependencies, self.dependents):
+                        for next in edges.get(key, ()):
+                            if next in visited:
+                                continue
+                            visited.add(next)
+                            next_frontier.append(next)
+                            if next in targets:
+                                found[next] = depth
+                frontier = next_frontier
+            return {self.nodes[key][0]: depth for key, depth in found.items()}
+
+    def dependencies_between(self, snippet_ids: List[str]) -> List[Dependency]:
+        """Edges whose both ends are in `snippet_ids`."""
+        with self.lock:
+            self.sync()
+            keys = {self.keys[id] for id in snippet_ids if id in self.keys}
+            return [
+                Dependency(self.nodes[key][0], self.nodes[dependency][0])
+                for key in keys
+                for dependency in self.dependencies.get(key, ())
+                if dependency in keys
+            ]
+
+
+snippet_graph = SnippetGraph()
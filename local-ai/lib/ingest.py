@@ -1,9 +1,31 @@
+import hashlib
+import itertools
+import multiprocessing
 import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-from lib.chunking import chunk_python_code, chunk_js_ts_code
-from lib.context import get_git_tracked_files
+from lib.args import jobs
+from lib.chunking import chunk_python_code, chunk_js_ts_code, chunk_js_ts_files
+from lib.context import get_git_tracked_files, filter_git_tracked_files
 from lib.log import log
-from lib.db import upsert_snippet, upsert_dependency, cleanup_data
+from lib.parser_worker import invalidate_module_resolutions
+from lib.tokens import token_length
+from lib.vectors import embed_missing_snippets
+from lib.db import (
+    upsert_snippets_bulk,
+    upsert_dependencies_bulk,
+    upsert_file_records_bulk,
+    delete_snippets_by_sources,
+    resolve_dependencies,
+    delete_file_data,
+    fetch_file_records,
+    fetch_file_records_by_paths,
+    cleanup_data,
+    transaction,
+)
 from watchdog.events import (
     FileSystemEventHandler,
     DirDeletedEvent,
@@ -13,8 +35,7 @@ from watchdog.events import (
 )
 from watchdog.observers import Observer
 
-from lib.types import Dependency, Snippet
-from typing import List
+from lib.types import FileRecord
 
 config = {
     "file_processors": {
@@ -22,7 +43,15 @@ config = {
         ".js": chunk_js_ts_code,
         ".ts": chunk_js_ts_code,
         ".tsx": chunk_js_ts_code,
-    }
+    },
+    # Chunkers that take many files at once, used instead of the above when ingesting
+    "batch_processors": {
+        ".js": chunk_js_ts_files,
+        ".ts": chunk_js_ts_files,
+        ".tsx": chunk_js_ts_files,
+    },
+    # Never descended into by the watcher, whatever the ignore files say
+    "ignored_directories": {".git", "node_modules", "__pycache__", ".venv"},
 }
 
 
@@ -37,66 +66,395 @@ def read_file(filepath):
     return None
 
 
-def delete_file_snippets(directory, file):
-    filepath = f"{directory}/{file}"
-    cleanup_data(filepath)
+def get_processor(file):
+    return config["file_processors"].get(os.path.splitext(file)[1])
+
+
+def hash_content(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def read_file_record(filepath) -> FileRecord:
+    stat = os.stat(filepath)
+    with open(filepath, "rb") as f:
+        return FileRecord(
+            filepath, stat.st_mtime_ns, stat.st_size, hash_content(f.read())
+        )
+
+
+# Cleared when the tokenizer can't be loaded, e.g. offline
+count_tokens_on_ingest = True
+
+
+def count_snippet_tokens(chunks):
+    """Store token counts on the snippets, before they reach the writer.
+
+    Without a tokenizer the counts stay None and are counted on first use.
+    """
+    global count_tokens_on_ingest
+    if not count_tokens_on_ingest:
+        return chunks
+    (snippets, _) = chunks
+    try:
+        for snippet in snippets:
+            if snippet.tokens is None:
+                snippet.tokens = token_length(snippet.content)
+    except Exception as e:
+        log.warning(f"Not counting snippet tokens during ingest: {e}")
+        count_tokens_on_ingest = False
+    return chunks
+
 
+def chunk_file(directory, source_directory, file, known_hash=None):
+    """Chunk one file without touching the database, so it can run in a worker process.
 
-def process_file(directory, source_directory, file):
+    Returns the file's manifest record together with its snippets and dependencies,
+    or with None in their place when the content still matches `known_hash`.
+    Returns None when the file could not be chunked.
+    """
     filepath = f"{directory}/{file}"
-    local_file_path = filepath.removeprefix(f"{directory}/")
-    modulepath = local_file_path.removeprefix(f"{source_directory}/").replace("/", ".")
-    for ext in config["file_processors"]:
-        if filepath.endswith(ext):
-            modulepath = modulepath.removesuffix(ext)
-            break
-
-    log.info(f"Processing file: {filepath}")
-    processor = config["file_processors"].get(os.path.splitext(file)[1])
+    processor = get_processor(file)
     if not processor:
         log.info(f"No processor found for file {filepath}. Skipping.")
-        return
+        return None
+    try:
+        record = read_file_record(filepath)
+        if record.hash == known_hash:
+            return (record, None)
+        log.info(f"Processing file: {filepath}")
+        chunks = processor(filepath)
+        if chunks is None:
+            return None
+        return (record, count_snippet_tokens(chunks))
+    except Exception as e:
+        log.error(f"Failed to chunk file {filepath}: {e}")
+        return None
+
+
+def chunk_file_batch(directory, files, processor):
+    """Like chunk_file for many files handled by one batch processor.
+
+    Parsing starts before this returns, the results are an iterator.
+    """
+    unchanged = []
+    records = {}
+    for file, known_hash in files:
+        filepath = f"{directory}/{file}"
+        try:
+            record = read_file_record(filepath)
+        except OSError as e:
+            log.error(f"Failed to read file {filepath}: {e}")
+            continue
+        if record.hash == known_hash:
+            unchanged.append((record, None))
+        else:
+            records[filepath] = record
+    if not records:
+        return iter(unchanged)
+    log.info(f"Processing {len(records)} files in batches")
+    results = processor(list(records))
+    return itertools.chain(
+        unchanged,
+        ((records[path], count_snippet_tokens(chunks)) for path, chunks in results),
+    )
+
+
+# Starting spawned workers takes about a second, fewer files are chunked in process
+min_pool_files = 50
+
+
+def chunk_changed_files(directory, source_directory, changed, jobs=1):
+    """Yield chunk_file results for (file, known_hash) pairs.
+
+    Files with a batch processor are parsed in the background while the
+    others are chunked, in a process pool when `jobs` > 1.
+    """
+    batches = {}
+    single = []
+    for file, known_hash in changed:
+        processor = config["batch_processors"].get(os.path.splitext(file)[1])
+        if processor:
+            batches.setdefault(processor, []).append((file, known_hash))
+        else:
+            single.append((file, known_hash))
+    batch_results = [
+        chunk_file_batch(directory, files, processor)
+        for processor, files in batches.items()
+    ]
+
+    if jobs <= 1 or len(single) < min_pool_files:
+        for file, known_hash in single:
+            yield chunk_file(directory, source_directory, file, known_hash)
+    else:
+        # Chunk in a process pool, the calling process is the only database writer.
+        # Spawned rather than forked, a fork of this multithreaded process could
+        # inherit held locks, the writer connection and the parser workers' pipes
+        log.info(f"Chunking {len(single)} files with {jobs} processes")
+        (files, hashes) = zip(*single)
+        with ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            yield from executor.map(
+                partial(chunk_file, directory, source_directory),
+                files,
+                hashes,
+                chunksize=max(1, min(32, len(files) // (jobs * 4))),
+            )
+
+    for results in batch_results:
+        yield from results
+
+
+def write_chunks(results, batch_size=100):
+    """Write chunking results, committing once per batch of files."""
+    batch = []
+    for result in results:
+        if result:
+            batch.append(result)
+        if len(batch) >= batch_size:
+            write_batch(batch)
+            batch = []
+    if batch:
+        write_batch(batch)
 
-    (snippets, dependencies) = processor(filepath)
-    for snippet in snippets:
-        upsert_snippet(snippet)
-    for dependency in dependencies:
-        upsert_dependency(dependency)
 
+def write_batch(batch):
+    chunked = [chunks for _, chunks in batch if chunks is not None]
+    sources = [record.path for record, chunks in batch if chunks is not None]
+    with transaction():
+        delete_snippets_by_sources(sources)
+        # Snippets of the whole batch go in first so edges between its files
+        # resolve directly
+        for snippets, _ in chunked:
+            upsert_snippets_bulk(snippets)
+        for _, dependencies in chunked:
+            upsert_dependencies_bulk(dependencies)
+        resolve_dependencies(sources)
+        upsert_file_records_bulk([record for record, _ in batch])
 
-def ingest_codebase(directory, source_directory):
-    cleanup_data(directory)
-    filepaths = get_git_tracked_files(directory)
-    for file in filepaths:
-        process_file(directory, source_directory, file)
+
+def find_changed_files(directory, files, records):
+    """Split tracked files into changed ones and ones that no longer exist.
+
+    Files whose mtime and size match the manifest are assumed unchanged.
+    """
+    changed = []
+    missing = []
+    for file in files:
+        filepath = f"{directory}/{file}"
+        try:
+            stat = os.stat(filepath)
+        except FileNotFoundError:
+            missing.append(filepath)
+            continue
+        record = records.get(filepath)
+        if (
+            record is None
+            or record.mtime != stat.st_mtime_ns
+            or record.size != stat.st_size
+        ):
+            changed.append((file, record and record.hash))
+    return (changed, missing)
+
+
+def ingest_codebase(directory, source_directory, jobs=jobs):
+    records = fetch_file_records(directory)
+    if not records:
+        # Nothing recorded yet, drop anything ingested before the manifest existed
+        cleanup_data(directory)
+    filepaths = [
+        file for file in get_git_tracked_files(directory) if get_processor(file)
+    ]
+    (changed, missing) = find_changed_files(directory, filepaths, records)
+    tracked = {f"{directory}/{file}" for file in filepaths}
+    removed = [path for path in records if path not in tracked] + missing
+    if removed or any(known_hash is None for _, known_hash in changed):
+        # Imports may resolve to other files now
+        invalidate_module_resolutions()
+    if removed:
+        log.info(f"Removing {len(removed)} deleted files")
+        delete_file_data(removed)
+    if changed:
+        write_chunks(chunk_changed_files(directory, source_directory, changed, jobs))
+    embed_new_snippets()
+
+
+embedding_condition = threading.Condition()
+embedding_running = False
+embedding_again = False
+# After a failure, e.g. without the model pulled, embedding is retried this
+# many seconds later at the earliest
+embedding_retry_after = 300
+embedding_failed_at = None
+
+
+def embed_new_snippets():
+    """Embed snippets that have no vector yet, in a background thread.
+
+    Requests while a run is in progress start one more run after it.
+    """
+    global embedding_running, embedding_again
+    with embedding_condition:
+        if (
+            embedding_failed_at is not None
+            and time.monotonic() - embedding_failed_at < embedding_retry_after
+        ):
+            return
+        if embedding_running:
+            embedding_again = True
+            return
+        embedding_running = True
+    threading.Thread(target=run_embedding, name="embed-snippets", daemon=True).start()
+
+
+def run_embedding():
+    global embedding_running, embedding_again, embedding_failed_at
+    while True:
+        failed_at = None
+        # Embedding needs a running Ollama, without it the rest of ingest still works
+        try:
+            embed_missing_snippets()
+        except Exception as e:
+            log.warning(f"Could not embed snippets for semantic search: {e}")
+            failed_at = time.monotonic()
+        with embedding_condition:
+            embedding_failed_at = failed_at
+            if failed_at is None and embedding_again:
+                embedding_again = False
+                continue
+            embedding_running = False
+            embedding_again = False
+            embedding_condition.notify_all()
+            return
+
+
+def wait_for_embeddings():
+    with embedding_condition:
+        embedding_condition.wait_for(lambda: not embedding_running)
+
+
+class IngestQueue:
+    """Ingests files touched by watcher events from a background thread.
+
+    Repeated events for a path collapse into one, and a path is only ingested
+    once it has been quiet for `debounce` seconds. Paths git doesn't track are
+    dropped when the batch is drained.
+    """
+
+    def __init__(self, directory, source_directory, debounce=0.5, batch_size=100):
+        self.directory = directory
+        self.source_directory = source_directory
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.pending = {}  # path relative to directory -> time of its latest event
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.run, name="ingest-queue", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def push(self, file):
+        if not is_watched_file(file):
+            return
+        with self.condition:
+            self.pending[file] = time.monotonic()
+            self.condition.notify()
+
+    def take_batch(self):
+        with self.condition:
+            while True:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                now = time.monotonic()
+                ready = [
+                    file
+                    for file, touched in self.pending.items()
+                    if now - touched >= self.debounce
+                ][: self.batch_size]
+                if ready:
+                    for file in ready:
+                        del self.pending[file]
+                    return ready
+                self.condition.wait(min(self.pending.values()) + self.debounce - now)
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            try:
+                self.ingest(batch)
+            except Exception as e:
+                log.error(f"Failed to ingest changed files: {e}")
+
+    def ingest(self, batch):
+        existing = [
+            file for file in batch if os.path.exists(f"{self.directory}/{file}")
+        ]
+        deleted = [f"{self.directory}/{file}" for file in batch if file not in existing]
+        if deleted:
+            delete_file_data(deleted)
+        tracked = filter_git_tracked_files(self.directory, existing)
+        if not tracked:
+            return
+        paths = {file: f"{self.directory}/{file}" for file in tracked}
+        records = fetch_file_records_by_paths(list(paths.values()))
+        write_chunks(
+            chunk_changed_files(
+                self.directory,
+                self.source_directory,
+                [
+                    (file, records[path].hash if path in records else None)
+                    for file, path in paths.items()
+                ],
+            )
+        )
+        embed_new_snippets()
+
+
+def is_watched_file(file):
+    parts = file.split("/")
+    return get_processor(file) is not None and not any(
+        part in config["ignored_directories"] for part in parts
+    )
 
 
 # Start the file watcher
 def start_watcher(directory, source_directory):
+    ingest_queue = IngestQueue(directory, source_directory)
+
+    def relative_path(path):
+        return path[len(directory) + 1 :]
+
+    def invalidate_resolutions(*paths):
+        # Only source files can be import targets, writes to .git, node_modules
+        # or the database keep the cached resolutions
+        if any(is_watched_file(relative_path(path)) for path in paths):
+            invalidate_module_resolutions()
+
     class CodebaseEventHandler(FileSystemEventHandler):
         def on_modified(self, event):
             if not event.is_directory:
-                process_file(
-                    directory, source_directory, event.src_path[len(directory) + 1 :]
-                )
+                ingest_queue.push(relative_path(event.src_path))
 
         def on_created(self, event):
+            invalidate_resolutions(event.src_path)
             if not event.is_directory:
-                process_file(
-                    directory, source_directory, event.src_path[len(directory) + 1 :]
-                )
+                ingest_queue.push(relative_path(event.src_path))
 
         def on_deleted(self, event: DirDeletedEvent | FileDeletedEvent) -> None:
+            invalidate_resolutions(event.src_path)
             if not event.is_directory:
-                delete_file_snippets(directory, event.src_path[len(directory) + 1 :])
+                ingest_queue.push(relative_path(event.src_path))
 
         def on_moved(self, event: DirMovedEvent | FileMovedEvent) -> None:
+            invalidate_resolutions(event.src_path, event.dest_path)
             if not event.is_directory:
-                process_file(
-                    directory, source_directory, event.src_path[len(directory) + 1 :]
-                )
-                delete_file_snippets(directory, event.src_path[len(directory) + 1 :])
+                ingest_queue.push(relative_path(event.src_path))
+                ingest_queue.push(relative_path(event.dest_path))
 
+    ingest_queue.start()
     event_handler = CodebaseEventHandler()
     observer = Observer()
     observer.schedule(event_handler, path=directory, recursive=True)
@@ -0,0 +1,105 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
+
+import ollama
+
+from lib.db import fetch_assistant_by_name
+from lib.log import log
+
+# Seconds a model listing is reused
+models_ttl = 60
+# Loaded models take more memory than their files, mostly for the KV cache
+load_overhead = 1.2
+
+
+def get_model_memory() -> Optional[int]:
+    """Bytes the loaded models may use together, None when unknown."""
+    if os.getenv("MODEL_MEMORY_GB"):
+        return int(float(os.getenv("MODEL_MEMORY_GB")) * 2**30)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 3 // 4
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+model_memory = get_model_memory()
+
+installed_models: Dict[str, int] = {}  # name -> size in bytes
+installed_models_at = None
+installed_models_lock = threading.Lock()
+
+
+def list_models() -> List[str]:
+    """Names of the installed models, cached for `models_ttl` seconds."""
+    global installed_models, installed_models_at
+    with installed_models_lock:
+        if (
+            installed_models_at is None
+            or time.monotonic() - installed_models_at >= models_ttl
+        ):
+            try:
+                installed_models = {
+                    model.model: model.size for model in ollama.list()["models"]
+                }
+            except Exception as e:
+                log.warning(f"Could not list Ollama models: {e}")
+            installed_models_at = time.monotonic()
+        return list(installed_models)
+
+
+def keep_alive_value(keep_alive: Optional[str]) -> Union[str, float, None]:
+    """Ollama takes a duration like "5m" or a number of seconds, -1 for ever."""
+    if not keep_alive:
+        return None
+    try:
+        return float(keep_alive)
+    except ValueError:
+        return keep_alive
+
+
+def unload_models_not_fitting(model: str):
+    """Unload running models that would not fit in memory next to `model`."""
+    list_models()
+    size = installed_models.get(model)
+    if model_memory is None or size is None:
+        return
+    running = [m for m in ollama.ps()["models"] if m.model != model]
+    needed = size * load_overhead + sum(m.size for m in running)
+    # Least recently loaded first, the soonest to expire anyway
+    for running_model in sorted(running, key=lambda m: m.expires_at):
+        if needed <= model_memory:
+            break
+        log.info(f"Unloading {running_model.model} to make room for {model}")
+        ollama.generate(model=running_model.model, keep_alive=0)
+        needed -= running_model.size
+
+
+# One load at a time, requests that are stale when their turn comes are skipped
+preload_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preload")
+preload_requested = None
+
+
+def preload(model: str, keep_alive: Optional[str]):
+    if model != preload_requested:
+        return
+    try:
+        unload_models_not_fitting(model)
+        started = time.monotonic()
+        # A request without a prompt only loads the model
+        ollama.generate(model=model, keep_alive=keep_alive_value(keep_alive))
+        log.info(f"Loaded {model} in {time.monotonic() - started:.1f} s")
+    except Exception as e:
+        log.warning(f"Could not preload {model}: {e}")
+
+
+def preload_assistant(assistant_name: str):
+    """Load the assistant's model in the background."""
+    global preload_requested
+    assistant = fetch_assistant_by_name(assistant_name)
+    if assistant is None or not assistant.llm:
+        return
+    preload_requested = assistant.llm
+    preload_executor.submit(preload, assistant.llm, assistant.keep_alive)
@@ -0,0 +1,174 @@
+import ast
+import copy
+from dataclasses import dataclass
+from typing import List, Optional
+
+from lib.graph import snippet_graph
+from lib.tokens import count_tokens
+from lib.types import Snippet
+
+# Lower ranks are packed first among equally close snippets. Whole files
+# and import blocks mostly repeat what the declarations already show.
+TYPE_RANKS = {
+    "type": 0,
+    "interface": 0,
+    "enum": 0,
+    "class": 1,
+    "function": 1,
+    "variable": 2,
+    "assignment": 2,
+    "other": 3,
+    "imports": 4,
+    "file": 5,
+}
+# Search hits further than this from the selection rank after all others
+max_distance = 3
+# Header, fences and newlines around each snippet
+snippet_overhead = 8
+
+
+@dataclass
+class PackedSnippet:
+    snippet: Snippet
+    fidelity: str  # "full", "signature" or "omitted"
+    content: str
+    tokens: int
+
+
+def outline_python_node(node) -> Optional[ast.AST]:
+    """The node without bodies, keeping docstrings and class fields."""
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        stub = copy.copy(node)
+        body = []
+        docstring = ast.get_docstring(node)
+        if docstring:
+            body.append(ast.Expr(ast.Constant(docstring.split("\n\n")[0])))
+        if isinstance(node, ast.ClassDef):
+            body += [
+                outline
+                for child in node.body
+                if (outline := outline_python_node(child)) is not None
+            ]
+        stub.body = body or [ast.Expr(ast.Constant(...))]
+        if isinstance(node, ast.ClassDef) or not docstring:
+            return stub
+        stub.body.append(ast.Expr(ast.Constant(...)))
+        return stub
+    if isinstance(node, (ast.Assign, ast.AnnAssign)):
+        if len(ast.unparse(node)) <= 120:
+            return node
+        stub = copy.copy(node)
+        stub.value = ast.Constant(...)
+        return stub
+    return None
+
+
+def outline_python(content: str) -> Optional[str]:
+    try:
+        module = ast.parse(content)
+    except SyntaxError:
+        return None
+    body = [
+        outline
+        for node in module.body
+        if (outline := outline_python_node(node)) is not None
+    ]
+    docstring = ast.get_docstring(module)
+    if docstring:
+        body.insert(0, ast.Expr(ast.Constant(docstring.split("\n\n")[0])))
+    return ast.unparse(ast.Module(body, [])) if body else None
+
+
+def outline_braces(content: str, members: bool) -> str:
+    """Lines outside braces, and for classes their members' first lines."""
+    lines = []
+    depth = 0
+    elided = False
+    for line in content.split("\n"):
+        start_depth = depth
+        depth = max(0, depth + line.count("{") - line.count("}"))
+        if start_depth == 0 or depth == 0 or (members and 1 in (start_depth, depth)):
+            lines.append(line)
+            elided = False
+        elif not elided:
+            lines.append(" " * (len(line) - len(line.lstrip())) + "...")
+            elided = True
+    return "\n".join(lines)
+
+
+def outline_snippet(snippet: Snippet) -> Optional[str]:
+    """Signatures and docstrings of the snippet, None when that is not shorter."""
+    if snippet.source.endswith(".py"):
+        outline = outline_python(snippet.content)
+    else:
+        outline = outline_braces(snippet.content, members=snippet.type == "class")
+    if outline is None or len(outline) >= len(snippet.content):
+        return None
+    return outline
+
+
+def rank_snippets(snippets: List[Snippet], selected_ids: List[str]) -> List[Snippet]:
+    """Selected snippets first, then the rest by graph distance from them.
+
+    The selection also holds the snippets its Dependencies and Dependents
+    options pulled in, so within it snippets linked to more of the others,
+    like the one that was picked, come first.
+    """
+    selected = set(selected_ids)
+    ids = [snippet.id for snippet in snippets]
+    distances = snippet_graph.distances(
+        list(selected), [id for id in ids if id not in selected], max_distance
+    )
+    links = dict.fromkeys(selected, 0)
+    for dependency in snippet_graph.dependencies_between(list(selected)):
+        links[dependency.snippet_id] += 1
+        links[dependency.dependency_name] += 1
+    order = {id: position for position, id in enumerate(ids)}
+    return sorted(
+        snippets,
+        key=lambda snippet: (
+            (
+                0
+                if snippet.id in selected
+                else distances.get(snippet.id, max_distance + 1)
+            ),
+            -links.get(snippet.id, 0),
+            TYPE_RANKS.get(snippet.type, 3),
+            order[snippet.id],
+        ),
+    )
+
+
+def pack_snippets(
+    snippets: List[Snippet], selected_ids: List[str], budget: int
+) -> List[PackedSnippet]:
+    """Fit the snippets into `budget` tokens, in rank order.
+
+    Each snippet goes in whole if it fits, else as its outline if that
+    fits, else it is omitted.
+    """
+    packed = []
+    remaining = budget
+    for snippet in rank_snippets(snippets, selected_ids):
+        tokens = get_snippet_tokens(snippet)
+        if tokens + snippet_overhead <= remaining:
+            packed.append(PackedSnippet(snippet, "full", snippet.content, tokens))
+            remaining -= tokens + snippet_overhead
+            continue
+        outline = outline_snippet(snippet)
+        if outline is not None:
+            outline_tokens = count_tokens(outline)
+            if outline_tokens + snippet_overhead <= remaining:
+                packed.append(
+                    PackedSnippet(snippet, "signature", outline, outline_tokens)
+                )
+                remaining -= outline_tokens + snippet_overhead
+                continue
+        packed.append(PackedSnippet(snippet, "omitted", "", 0))
+    return packed
+
+
+def get_snippet_tokens(snippet: Snippet) -> int:
+    if snippet.tokens is None:
+        return count_tokens(snippet.content)
+    return snippet.tokens
@@ -0,0 +1,255 @@
+import atexit
+import json
+import os
+import queue
+import subprocess
+import threading
+
+from lib.log import log
+
+PARSER_PATH = os.path.abspath(
+    os.path.join(
+        os.path.dirname(__file__), "..", "..", "parsers", "typescript", "parser.js"
+    )
+)
+
+
+class ParserError(Exception):
+    pass
+
+
+class ParserStartError(ParserError):
+    """The worker could not start, e.g. node or the typescript package is missing."""
+
+
+class ParserWorker:
+    """A long-lived `node parser.js --worker` process.
+
+    Requests and responses are newline-delimited JSON, so the `typescript`
+    package is loaded once per worker instead of once per file.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.request_id = 0
+        # Set when files were added or removed since the worker last resolved imports
+        self.stale_resolutions = False
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen(
+                ["node", PARSER_PATH, "--worker"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                encoding="utf-8",
+            )
+        except OSError as e:
+            raise ParserStartError(f"Could not run node: {e}") from e
+        # The worker announces itself once typescript is loaded
+        line = self.process.stdout.readline()
+        if not line or not json.loads(line).get("ready"):
+            self.stop()
+            raise ParserStartError("TypeScript parser worker exited at startup")
+        self.stale_resolutions = False
+        log.debug(f"Started TypeScript parser worker (pid {self.process.pid})")
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+
+    def send(self, request):
+        if not self.is_alive():
+            self.start()
+        self.request_id += 1
+        if self.stale_resolutions:
+            request = {**request, "invalidate": True}
+            self.stale_resolutions = False
+        self.process.stdin.write(json.dumps({"id": self.request_id, **request}) + "\n")
+        self.process.stdin.flush()
+
+    def responses(self):
+        """Yield response lines belonging to the latest request."""
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                raise BrokenPipeError("TypeScript parser worker exited unexpectedly")
+            response = json.loads(line)
+            if response.get("id") != self.request_id:
+                # Left over from a request whose reader stopped early
+                continue
+            yield response
+
+    def request(self, filepath, root):
+        """Yield the chunk and dependency records of one file as they arrive."""
+        self.send({"file": filepath, "root": root})
+        for response in self.responses():
+            if response.get("error"):
+                raise ParserError(response["error"])
+            if response.get("done"):
+                return
+            yield response
+
+    def request_batch(self, filepaths, root):
+        """Yield (filepath, records) as each file of the batch finishes.
+
+        `records` is None for files the parser failed on.
+        """
+        self.send({"files": filepaths, "root": root})
+        records = []
+        for response in self.responses():
+            if response.get("end"):
+                return
+            if response.get("error"):
+                log.error(
+                    f"Failed to parse file {response['file']}: {response['error']}"
+                )
+                yield (response["file"], None)
+                records = []
+            elif response.get("done"):
+                yield (response["file"], records)
+                records = []
+            else:
+                records.append(response)
+
+
+class ParserPool:
+    def __init__(self, size):
+        self.workers = [ParserWorker() for _ in range(size)]
+        self.idle = queue.LifoQueue()
+        for worker in self.workers:
+            self.idle.put(worker)
+        # Set once a worker failed to start, later requests fail without respawning
+        self.start_error = None
+
+    def start_failed(self, e):
+        if self.start_error is None:
+            log.error(f"{e}, JavaScript and TypeScript files will not be parsed")
+        self.start_error = e
+
+    def parse(self, filepath, root):
+        if self.start_error is not None:
+            raise self.start_error
+        worker = self.idle.get()
+        received = False
+        try:
+            for attempt in range(2):
+                try:
+                    for record in worker.request(filepath, root):
+                        received = True
+                        yield record
+                    return
+                except ParserStartError as e:
+                    self.start_failed(e)
+                    raise
+                except OSError as e:
+                    worker.stop()
+                    # Only retry when nothing has been handed to the caller yet
+                    if received or attempt:
+                        raise
+                    log.warning(f"TypeScript parser worker crashed ({e}), restarting")
+        finally:
+            self.idle.put(worker)
+
+    def parse_batch(self, filepaths, root):
+        """Parse files split across all workers, starting right away.
+
+        Returns an iterator of (filepath, records) in completion order, where
+        `records` is None for files that failed to parse.
+        """
+        if self.start_error is not None:
+            return iter([(file, None) for file in filepaths])
+        results = queue.Queue()
+        finished = object()
+        slices = [filepaths[i :: len(self.workers)] for i in range(len(self.workers))]
+        slices = [files for files in slices if files]
+
+        def run(files):
+            worker = self.idle.get()
+            completed = 0
+            try:
+                while completed < len(files):
+                    try:
+                        for result in worker.request_batch(files[completed:], root):
+                            results.put(result)
+                            completed += 1
+                    except OSError as e:
+                        # The file being parsed took the worker down, retry the rest
+                        log.warning(
+                            f"TypeScript parser worker crashed on {files[completed]} ({e}), restarting"
+                        )
+                        worker.stop()
+                        results.put((files[completed], None))
+                        completed += 1
+            except ParserStartError as e:
+                self.start_failed(e)
+                for file in files[completed:]:
+                    results.put((file, None))
+            except Exception as e:
+                log.error(f"TypeScript parser batch failed: {e}")
+                for file in files[completed:]:
+                    results.put((file, None))
+            finally:
+                self.idle.put(worker)
+                results.put(finished)
+
+        for files in slices:
+            threading.Thread(target=run, args=(files,), daemon=True).start()
+
+        def collect():
+            remaining = len(slices)
+            while remaining:
+                result = results.get()
+                if result is finished:
+                    remaining -= 1
+                else:
+                    yield result
+
+        return collect()
+
+    def invalidate_resolutions(self):
+        for worker in self.workers:
+            worker.stale_resolutions = True
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.stop()
+
+
+pool_size = int(os.getenv("PARSER_WORKERS", min(4, os.cpu_count() or 1)))
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_parser_pool() -> ParserPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ParserPool(pool_size)
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def parse_js_ts_file(filepath, root):
+    return get_parser_pool().parse(filepath, root)
+
+
+def parse_js_ts_files(filepaths, root):
+    return get_parser_pool().parse_batch(filepaths, root)
+
+
+def invalidate_module_resolutions():
+    """Make the workers resolve imports again, after files were added or removed."""
+    with _pool_lock:
+        if _pool is not None:
+            _pool.invalidate_resolutions()
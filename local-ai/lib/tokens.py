@@ -0,0 +1,59 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import tiktoken
+
+# Loaded on first use, tiktoken downloads the encoding the first time
+tokenizer = None
+tokenizer_lock = threading.Lock()
+
+# Token counts of recently counted texts, by content hash
+token_counts: OrderedDict = OrderedDict()
+token_counts_size = 4096
+token_counts_lock = threading.Lock()
+
+
+def get_tokenizer():
+    global tokenizer
+    with tokenizer_lock:
+        if tokenizer is None:
+            tokenizer = tiktoken.encoding_for_model("gpt-4o")
+        return tokenizer
+
+
+def token_length(text: str) -> int:
+    """Token count of `text`, without the cache, for counting many texts once."""
+    return len(get_tokenizer().encode(text)) if text else 0
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+def store_count(key: bytes, tokens: int):
+    with token_counts_lock:
+        token_counts[key] = tokens
+        token_counts.move_to_end(key)
+        while len(token_counts) > token_counts_size:
+            token_counts.popitem(last=False)
+
+
+def remember_tokens(text: str, tokens: int):
+    """Record an already known count, for example one stored in the database."""
+    store_count(text_key(text), tokens)
+
+
+def count_tokens(text: str) -> int:
+    """Token count of `text`, encoded only the first time it is seen."""
+    if not text:
+        return 0
+    key = text_key(text)
+    with token_counts_lock:
+        tokens = token_counts.get(key)
+        if tokens is not None:
+            token_counts.move_to_end(key)
+            return tokens
+    tokens = token_length(text)
+    store_count(key, tokens)
+    return tokens
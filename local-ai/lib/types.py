@@ -1,5 +1,5 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
 
 
 @dataclass
@@ -9,6 +9,10 @@ class Assistant:
     context_limit: int
     response_size_limit: int
     prompt: str = ""
+    # Tokens the context system message may take, see lib.packing
+    context_budget: int = 8000
+    # How long Ollama keeps the model loaded after a request, see lib.models
+    keep_alive: str = "5m"
 
 
 @dataclass
@@ -17,10 +21,28 @@ class Snippet:
     source: str
     module: str
     name: str | None
-    content: str
+    # Read and written through `content`
+    _content: str | None = field(repr=False)
     start_line: int
     end_line: int
     type: str
+    tokens: Optional[int] = None
+    # Set for snippets read without their content, which is then loaded on
+    # first access of `content`
+    load_content: Optional[Callable[[], str]] = field(
+        default=None, repr=False, compare=False
+    )
+
+    @property
+    def content(self) -> str:
+        if self.load_content is not None:
+            self._content = self.load_content()
+            self.load_content = None
+        return self._content
+
+    @content.setter
+    def content(self, content: str):
+        self._content = content
 
 
 @dataclass
@@ -29,6 +51,14 @@ class Dependency:
     dependency_name: str
 
 
+@dataclass
+class FileRecord:
+    path: str
+    mtime: int
+    size: int
+    hash: str
+
+
 @dataclass
 class UIState:
     assistant_name: str = ""
@@ -0,0 +1,360 @@
+import json
+import os
+import re
+import threading
+import zlib
+from typing import List, Optional, Tuple
+
+import numpy as np
+import ollama
+
+import lib.db as db
+from lib.log import log
+from lib.types import Snippet
+
+# "stub" selects StubEmbedder, an empty value turns embeddings off
+embedding_model = os.getenv("EMBEDDING_MODEL", "nomic-embed-text")
+embedding_batch_size = 32
+max_embedding_chars = 8000
+# Above this many snippets searches only look at the clusters nearest the query
+ivf_min_rows = 50000
+ivf_probes = 16
+# The matrix file is rewritten once this share of its rows, and at least
+# `compact_min_rows`, belong to texts no snippet has anymore
+compact_dead_fraction = 0.25
+compact_min_rows = 1000
+
+
+class OllamaEmbedder:
+    def __init__(self, model: str):
+        self.model = model
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        response = ollama.embed(model=self.model, input=texts)
+        return np.asarray(response["embeddings"], dtype=np.float32)
+
+
+class StubEmbedder:
+    """Deterministic hashed bag-of-words embeddings, for running without Ollama."""
+
+    model = "stub"
+
+    def __init__(self, dimensions: int = 256):
+        self.dimensions = dimensions
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in re.findall(r"\w+", text.lower()):
+                h = zlib.crc32(word.encode("utf-8"))
+                vectors[i, h % self.dimensions] += 1.0 if h & 1 else -1.0
+        return vectors
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def train_centroids(vectors: np.ndarray, count: int, iterations: int = 10):
+    """Spherical k-means, the vectors are unit length so dot product is cosine."""
+    rng = np.random.default_rng(0)
+    centroids = vectors[rng.choice(len(vectors), count, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums)
+    return centroids
+
+
+def assign_clusters(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    return np.concatenate(
+        [
+            np.argmax(vectors[i : i + 8192] @ centroids.T, axis=1)
+            for i in range(0, len(vectors), 8192)
+        ]
+        or [np.zeros(0, dtype=np.int64)]
+    )
+
+
+class VectorIndex:
+    """Snippet embeddings of one model.
+
+    Vectors are normalized and appended to a float32 matrix file next to the
+    database, which is memory-mapped for searching. The `embeddings` table
+    maps text hashes to matrix rows, so a text is only ever embedded once.
+    """
+
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self.model = embedder.model
+        self.path = f"{db.db_path}.{re.sub(r'[^A-Za-z0-9]+', '_', self.model)}.f32"
+        self.lock = threading.Lock()
+        self.dimensions = None
+        self.matrix = None
+        self.version = None
+        # Parallel arrays over the searchable snippets
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.ids = []
+        self.centroids = None
+        self.row_clusters = np.zeros(0, dtype=np.int64)
+        self.load_dimensions()
+
+    def load_dimensions(self):
+        row = (
+            db.read_cursor()
+            .execute(
+                "SELECT dimensions FROM embedding_models WHERE model = ?", (self.model,)
+            )
+            .fetchone()
+        )
+        if row is None:
+            return
+        self.dimensions = row[0]
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        count = size // (4 * self.dimensions)
+        # Rows the file lost, for instance when it was deleted, are embedded again
+        with db.transaction() as cursor:
+            cursor.execute(
+                "DELETE FROM embeddings WHERE model = ? AND row >= ?",
+                (self.model, count),
+            )
+        if size != count * 4 * self.dimensions:
+            os.truncate(self.path, count * 4 * self.dimensions)
+
+    def row_count(self):
+        if self.dimensions is None or not os.path.exists(self.path):
+            return 0
+        return os.path.getsize(self.path) // (4 * self.dimensions)
+
+    def add(self, snippets: List[Snippet]):
+        """Embed the snippets whose text has not been embedded before."""
+        texts = {
+            db.hash_text(snippet.content): snippet.content
+            for snippet in snippets
+            if snippet.type not in db.UNSEARCHED_TYPES
+        }
+        if not texts:
+            return
+        cursor = db.read_cursor()
+        cursor.execute(
+            "SELECT hash FROM embeddings WHERE model = ? AND hash IN (SELECT value FROM json_each(?))",
+            (self.model, json.dumps(list(texts))),
+        )
+        for (text_hash,) in cursor.fetchall():
+            del texts[text_hash]
+        hashes = list(texts)
+        for i in range(0, len(hashes), embedding_batch_size):
+            batch = hashes[i : i + embedding_batch_size]
+            vectors = normalize(
+                self.embedder.embed([texts[h][:max_embedding_chars] for h in batch])
+            )
+            self.append(batch, vectors.astype(np.float32))
+
+    def add_missing(self, page_size: int = 1000):
+        """Embed every searchable snippet whose text has no vector yet."""
+        while True:
+            cursor = db.read_cursor()
+            cursor.execute(
+                f"""
+                    SELECT {db.SNIPPET_COLUMNS} FROM snippets s
+                    WHERE s.type NOT IN ({db.UNSEARCHED_PLACEHOLDERS}) AND NOT EXISTS (
+                        SELECT 1 FROM embeddings e WHERE e.model = ? AND e.hash = s.text_hash
+                    )
+                    LIMIT ?
+                """,
+                (*db.UNSEARCHED_TYPES, self.model, page_size),
+            )
+            snippets = db.snippets_from_rows(cursor.fetchall(), with_content=True)
+            if not snippets:
+                break
+            self.add(snippets)
+        with self.lock:
+            if self.dimensions is None:
+                return
+            self.refresh()
+            count = self.row_count()
+            dead = count - len(np.unique(self.rows))
+            if dead >= max(compact_min_rows, compact_dead_fraction * count):
+                self.compact()
+
+    def compact(self):
+        """Rewrite the matrix file with only the rows snippets still use.
+
+        Called with the lock held and the matrix refreshed.
+        """
+        cursor = db.read_cursor()
+        cursor.execute(
+            f"""
+                SELECT hash, row FROM embeddings
+                WHERE model = ? AND hash IN (
+                    SELECT text_hash FROM snippets
+                    WHERE type NOT IN ({db.UNSEARCHED_PLACEHOLDERS})
+                )
+                ORDER BY row
+            """,
+            (self.model, *db.UNSEARCHED_TYPES),
+        )
+        live = cursor.fetchall()
+        rows = np.fromiter((row for (_, row) in live), dtype=np.int64, count=len(live))
+        compacted = f"{self.path}.compact"
+        with open(compacted, "wb") as f:
+            for i in range(0, len(rows), 8192):
+                f.write(np.asarray(self.matrix[rows[i : i + 8192]]).tobytes())
+        with db.transaction() as cursor:
+            cursor.execute("DELETE FROM embeddings WHERE model = ?", (self.model,))
+            cursor.executemany(
+                "INSERT INTO embeddings (model, hash, row) VALUES (?, ?, ?)",
+                [(self.model, h, i) for (i, (h, _)) in enumerate(live)],
+            )
+            # Last, so the new row numbers are rolled back if this fails
+            os.replace(compacted, self.path)
+        log.info(
+            f"Compacted {self.model} embeddings from {len(self.matrix)} rows to {len(live)}"
+        )
+        self.matrix = None
+        self.version = None
+        self.centroids = None
+        self.row_clusters = np.zeros(0, dtype=np.int64)
+
+    def append(self, hashes: List[str], vectors: np.ndarray):
+        with self.lock:
+            if self.dimensions is None:
+                self.dimensions = vectors.shape[1]
+                with db.transaction() as cursor:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO embedding_models (model, dimensions) VALUES (?, ?)",
+                        (self.model, self.dimensions),
+                    )
+            first = self.row_count()
+            with open(self.path, "ab") as f:
+                f.write(vectors.tobytes())
+            with db.transaction() as cursor:
+                cursor.executemany(
+                    "INSERT OR REPLACE INTO embeddings (model, hash, row) VALUES (?, ?, ?)",
+                    [(self.model, h, first + i) for (i, h) in enumerate(hashes)],
+                )
+
+    def refresh(self):
+        """Map the matrix file again and re-read which rows are searchable.
+
+        Runs only when snippets or the file changed since the last search.
+        """
+        count = self.row_count()
+        version = (db.index_version, count)
+        if version == self.version:
+            return
+        self.matrix = (
+            np.memmap(
+                self.path, dtype=np.float32, mode="r", shape=(count, self.dimensions)
+            )
+            if count
+            else None
+        )
+        cursor = db.read_cursor()
+        cursor.execute(
+            f"""
+                SELECT s.id, e.row FROM snippets s
+                JOIN embeddings e ON e.model = ? AND e.hash = s.text_hash
+                WHERE s.type NOT IN ({db.UNSEARCHED_PLACEHOLDERS})
+                ORDER BY e.row
+            """,
+            (self.model, *db.UNSEARCHED_TYPES),
+        )
+        rows = cursor.fetchall()
+        self.ids = [row[0] for row in rows]
+        self.rows = np.fromiter(
+            (row[1] for row in rows), dtype=np.int64, count=len(rows)
+        )
+        self.update_clusters(count)
+        self.version = version
+
+    def update_clusters(self, count):
+        if len(self.rows) < ivf_min_rows:
+            self.centroids = None
+            return
+        if self.centroids is None:
+            sample = self.rows[
+                np.random.default_rng(0).choice(
+                    len(self.rows), min(len(self.rows), 20000), replace=False
+                )
+            ]
+            self.centroids = train_centroids(
+                np.asarray(self.matrix[np.sort(sample)]), int(np.sqrt(len(self.rows)))
+            )
+            self.row_clusters = np.zeros(0, dtype=np.int64)
+        # Only rows appended since the last search need a cluster
+        known = len(self.row_clusters)
+        if known < count:
+            self.row_clusters = np.concatenate(
+                [
+                    self.row_clusters,
+                    assign_clusters(
+                        np.asarray(self.matrix[known:count]), self.centroids
+                    ),
+                ]
+            )
+
+    def search(self, query: str, limit: int = 10) -> List[Tuple[str, float]]:
+        """(snippet id, cosine similarity) of the snippets closest to `query`."""
+        vector = normalize(self.embedder.embed([query[:max_embedding_chars]]))[0]
+        with self.lock:
+            if self.dimensions is None:
+                return []
+            self.refresh()
+            if self.matrix is None or not len(self.rows):
+                return []
+            if self.centroids is not None:
+                probes = np.argsort(self.centroids @ vector)[-ivf_probes:]
+                candidates = np.flatnonzero(
+                    np.isin(self.row_clusters[self.rows], probes)
+                )
+                scores = np.asarray(self.matrix[self.rows[candidates]]) @ vector
+            else:
+                candidates = np.arange(len(self.rows))
+                # Only the rows in use, the file also holds vectors of old texts
+                scores = np.asarray(self.matrix[self.rows]) @ vector
+            limit = min(limit, len(scores))
+            if limit <= 0:
+                return []
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            top = top[np.argsort(-scores[top])]
+            return [(self.ids[candidates[i]], float(scores[i])) for i in top]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_vector_index() -> Optional[VectorIndex]:
+    """The index of the configured embedding model, None when turned off."""
+    global _index
+    with _index_lock:
+        if _index is None and embedding_model:
+            if embedding_model == "stub":
+                set_embedder(StubEmbedder())
+            else:
+                set_embedder(OllamaEmbedder(embedding_model))
+        return _index
+
+
+def set_embedder(embedder):
+    """Use `embedder`, for example a StubEmbedder in tests."""
+    global _index
+    _index = VectorIndex(embedder)
+
+
+def embed_missing_snippets():
+    index = get_vector_index()
+    if index is not None:
+        index.add_missing()
+
+
+def search_similar_snippets(query: str, limit: int = 10) -> List[Tuple[str, float]]:
+    index = get_vector_index()
+    if index is None:
+        return []
+    return index.search(query, limit)
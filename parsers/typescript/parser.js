@@ -28,6 +28,36 @@ function createChunk(sourceFile, node, moduleName, modulePath, type, name) {
     };
 }
 
+const RESOLVE_EXTENSIONS = ['.ts', '.tsx', '.js', '.jsx'];
+
+// Absolute import path -> file it resolves to. Kept for the worker's lifetime,
+// requests with `invalidate` clear it after files were added or removed
+const moduleResolutionCache = new Map();
+
+function isFile(filePath) {
+    try {
+        return fs.statSync(filePath).isFile();
+    } catch {
+        return false;
+    }
+}
+
+// Resolve './utils' to './utils.ts' or './utils/index.ts' when such a file
+// exists, so the import gets the same module path as the file's own chunks
+function resolveRelativeImport(currentFilePath, moduleSpecifier) {
+    const absolutePath = path.resolve(path.dirname(currentFilePath), moduleSpecifier);
+    let resolved = moduleResolutionCache.get(absolutePath);
+    if (resolved === undefined) {
+        const candidates = [
+            ...RESOLVE_EXTENSIONS.map((ext) => absolutePath + ext),
+            ...RESOLVE_EXTENSIONS.map((ext) => path.join(absolutePath, 'index' + ext)),
+        ];
+        resolved = candidates.find(isFile) ?? absolutePath;
+        moduleResolutionCache.set(absolutePath, resolved);
+    }
+    return resolved;
+}
+
 function extractImports(sourceFile, currentFilePath, projectRoot) {
     const imports = [];
     const importNodes = sourceFile.statements.filter(
@@ -38,9 +68,8 @@ function extractImports(sourceFile, currentFilePath, projectRoot) {
         const moduleSpecifier = node.moduleSpecifier.text;
         let modulePath = moduleSpecifier
         if (moduleSpecifier.startsWith('.')) {
-            const currentFileDir = path.dirname(currentFilePath);
-            const absolutePath = path.resolve(currentFileDir, moduleSpecifier);
-            const relativePath = path.relative(projectRoot, absolutePath);
+            const resolvedPath = resolveRelativeImport(currentFilePath, moduleSpecifier);
+            const relativePath = path.relative(projectRoot, resolvedPath);
 
             // Process the relative path to get module path
             const parts = moduleSpecifier.startsWith('.') ? relativePath.split(path.sep) : [moduleSpecifier];
@@ -90,7 +119,9 @@ function extractImports(sourceFile, currentFilePath, projectRoot) {
     return imports;
 }
 
-function parseFile(filePath, projectRoot) {
+// Calls emit({ chunk }) for every chunk and then emit({ dependency }) for
+// every unique dependency, so callers can stream results as they are produced.
+function parseFile(filePath, projectRoot, emit) {
     const fileContent = fs.readFileSync(filePath, 'utf-8');
     const sourceFile = ts.createSourceFile(
         filePath,
@@ -106,13 +137,20 @@ function parseFile(filePath, projectRoot) {
         .split(path.sep)
         .join('.') + '.' + moduleName;
 
-    const chunks = [];
-    const dependencies = [];
     const imports = extractImports(sourceFile, filePath, projectRoot);
 
+    function emitChunk(chunk) {
+        emit({
+            chunk: {
+                ...chunk,
+                content: chunk.content.replace(/\r?\n/g, '\n'), // Escape newlines
+            },
+        });
+    }
+
     // File chunk
     const totalLines = sourceFile.getLineStarts().length;
-    chunks.push({
+    emitChunk({
         id: modulePath,
         source: filePath,
         module: modulePath,
@@ -136,7 +174,7 @@ function parseFile(filePath, projectRoot) {
             sourceFile,
             importsNodes[importsNodes.length - 1].end
         );
-        chunks.push({
+        emitChunk({
             id: `${modulePath}._imports_`,
             source: filePath,
             module: modulePath,
@@ -196,54 +234,51 @@ function parseFile(filePath, projectRoot) {
             type,
             name
         );
-        declarationChunks.push(chunk);
+        declarationChunks.push({ chunk, node });
+        emitChunk(chunk);
     });
 
-    chunks.push(...declarationChunks);
+    // Create dependencies, skipping duplicates
+    const seen = new Set();
+    function addDependency(snippetId, dependencyName) {
+        const key = `${snippetId}\0${dependencyName}`;
+        if (!seen.has(key)) {
+            seen.add(key);
+            emit({
+                dependency: {
+                    snippet_id: snippetId,
+                    dependency_name: dependencyName,
+                },
+            });
+        }
+    }
 
-    // Create dependencies
     const nameToChunk = new Map();
-    declarationChunks.forEach((c) => nameToChunk.set(c.name, c));
+    declarationChunks.forEach(({ chunk }) => nameToChunk.set(chunk.name, chunk));
 
     // Dependency to imports chunk
     const importChunkId = `${modulePath}._imports_`;
-    chunks.forEach((chunk) => {
-        if (chunk.type !== 'imports' && chunk.type !== 'file') {
-            dependencies.push({
-                snippet_id: chunk.id,
-                dependency_name: importChunkId,
-            });
-        }
-    });
+    declarationChunks.forEach(({ chunk }) => addDependency(chunk.id, importChunkId));
 
     // Internal dependencies
-    declarationChunks.forEach((currentChunk) => {
-        const contentAST = ts.createSourceFile(
-            'temp.ts',
-            currentChunk.content,
-            ts.ScriptTarget.Latest,
-            true
-        );
-
+    declarationChunks.forEach(({ chunk: currentChunk, node }) => {
+        // Walk the declaration in the already parsed file instead of re-parsing its text
         const identifiers = new Set();
 
-        function collectIdentifiers(node) {
-            if (ts.isIdentifier(node)) {
-                identifiers.add(node.text);
+        function collectIdentifiers(child) {
+            if (ts.isIdentifier(child)) {
+                identifiers.add(child.text);
             }
-            ts.forEachChild(node, collectIdentifiers);
+            ts.forEachChild(child, collectIdentifiers);
         }
 
-        collectIdentifiers(contentAST);
+        collectIdentifiers(node);
 
         // Local dependencies
         identifiers.forEach((refName) => {
             const refChunk = nameToChunk.get(refName);
             if (refChunk && refChunk.id !== currentChunk.id) {
-                dependencies.push({
-                    snippet_id: currentChunk.id,
-                    dependency_name: refChunk.id,
-                });
+                addDependency(currentChunk.id, refChunk.id);
             }
         });
 
@@ -256,41 +291,130 @@ function parseFile(filePath, projectRoot) {
                 } else {
                     depName = `${imp.module}.${imp.name}`;
                 }
-                dependencies.push({
-                    snippet_id: currentChunk.id,
-                    dependency_name: depName,
-                });
-                dependencies.push({
-                    snippet_id: modulePath,
-                    dependency_name: depName,
-                })
+                addDependency(currentChunk.id, depName);
+                addDependency(modulePath, depName);
             }
         });
     });
+}
 
-    // Remove duplicates
-    const uniqueDeps = Array.from(
-        new Set(dependencies.map(JSON.stringify))
-    ).map(JSON.parse);
-
+// Buffers newline-delimited JSON so large files don't cost one write per line
+function createWriter() {
+    let buffer = [];
     return {
-        chunks: chunks.map((c) => ({
-            ...c,
-            content: c.content.replace(/\r?\n/g, '\n'), // Escape newlines
-        })),
-        dependencies: uniqueDeps,
+        write(record) {
+            buffer.push(JSON.stringify(record));
+            if (buffer.length >= 256) {
+                this.flush();
+            }
+        },
+        flush() {
+            if (buffer.length > 0) {
+                process.stdout.write(buffer.join('\n') + '\n');
+                buffer = [];
+            }
+        },
     };
 }
 
+// Parses files one after another with a shared module resolution cache,
+// calling emit(file, record) for each of their records and emit(file, { done: true })
+// or emit(file, { error }) when a file is finished
+function parseFiles(filePaths, projectRoot, emit) {
+    filePaths.forEach((filePath) => {
+        try {
+            parseFile(filePath, projectRoot, (record) => emit(filePath, record));
+            emit(filePath, { done: true });
+        } catch (error) {
+            emit(filePath, { error: String(error?.stack || error) });
+        }
+    });
+}
+
+// Worker mode: newline-delimited JSON requests on stdin, either
+// Starts with a ready line, then answers requests
+// { id, file, root } or { id, files, root }, optionally with invalidate: true
+// to drop cached import resolutions first. A single file is answered with its
+// chunk and dependency lines followed by a done (or error) line. A batch tags
+// lines with their file, closes each file with a done or error line and the
+// whole request with an end line.
+function runWorker() {
+    const readline = require('readline');
+    const rl = readline.createInterface({ input: process.stdin, terminal: false });
+    const writer = createWriter();
+    // Tells the caller typescript loaded and requests can be sent
+    writer.write({ ready: true });
+    writer.flush();
+
+    rl.on('line', (line) => {
+        if (!line.trim()) {
+            return;
+        }
+        let request;
+        try {
+            request = JSON.parse(line);
+            if (request.invalidate) {
+                moduleResolutionCache.clear();
+            }
+            if (request.files) {
+                parseFiles(request.files, request.root, (file, record) =>
+                    writer.write({ id: request.id, file, ...record })
+                );
+                writer.write({ id: request.id, end: true });
+            } else {
+                parseFile(request.file, request.root, (record) =>
+                    writer.write({ id: request.id, ...record })
+                );
+                writer.write({ id: request.id, done: true });
+            }
+        } catch (error) {
+            writer.write({ id: request?.id ?? null, error: String(error?.stack || error) });
+        }
+        writer.flush();
+    });
+    rl.on('close', () => process.exit(0));
+}
+
+function readStdinLines() {
+    return fs
+        .readFileSync(0, 'utf-8')
+        .split(/\r?\n/)
+        .filter((line) => line.trim());
+}
+
 // CLI entry point
 if (require.main === module) {
-    const filePath = process.argv[2];
-    const projectRoot = process.argv[3];
-    if (!filePath || !projectRoot) {
-        console.error('Usage: node parser.js <file.js> <project_root>');
-        process.exit(1);
-    }
+    const usage = [
+        'Usage: node parser.js <file.js> <project_root>',
+        '       node parser.js --batch <project_root> [file ...]   (files from stdin if none are given, e.g. `git ls-files | node parser.js --batch src`)',
+        '       node parser.js --worker',
+    ];
+    if (process.argv[2] === '--worker') {
+        runWorker();
+    } else if (process.argv[2] === '--batch') {
+        const projectRoot = process.argv[3];
+        if (!projectRoot) {
+            usage.forEach((line) => console.error(line));
+            process.exit(1);
+        }
+        const files = process.argv.length > 4 ? process.argv.slice(4) : readStdinLines();
+        const writer = createWriter();
+        parseFiles(
+            files.filter((file) => /\.(jsx?|tsx?)$/.test(file)),
+            projectRoot,
+            (file, record) => writer.write({ file, ...record })
+        );
+        writer.flush();
+    } else {
+        const filePath = process.argv[2];
+        const projectRoot = process.argv[3];
+        if (!filePath || !projectRoot) {
+            usage.forEach((line) => console.error(line));
+            process.exit(1);
+        }
 
-    const result = parseFile(filePath, projectRoot);
-    console.log(JSON.stringify(result, null, 2));
-}
\ No newline at end of file
+        const writer = createWriter();
+        parseFile(filePath, projectRoot, (record) => writer.write(record));
+        writer.flush();
+    }
+}